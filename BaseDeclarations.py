@@ -21,17 +21,26 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 import os
+import contextlib
 from sortedcontainers import SortedList
 from sqlalchemy import create_engine
 from sqlalchemy import inspect
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Text, String, Date
+from sqlalchemy import Column, Integer, Float, Text, String, Date, LargeBinary
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy import ForeignKey
+from sqlalchemy import bindparam
+from sqlalchemy import MetaData, Table, select, func
+from sqlalchemy.exc import IntegrityError
+import RegaLog
 
 
 DATABASE = 'results.db'
+BULK_BATCH_SIZE = 500
+MAX_GRID_LAYOUTS = 64                             # ServiceGrid.decode keeps the cells of that many page layouts
 Base = declarative_base()
 
 
@@ -41,6 +50,23 @@ class ServiceList(SortedList):
         self.add(item)
 
 
+class Bitmask(TypeDecorator):
+    """ Non-negative integer of any size, stored as little-endian bytes: SQLite integers stop at 63 bits, and the
+        passport grid has 150 cells """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return value.to_bytes((value.bit_length() + 7) // 8, 'little')
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return int.from_bytes(value, 'little')
+
+
 def buildInspectEmptyDict(base):
     d = dict()
     mapper = inspect(base)
@@ -65,6 +91,11 @@ class CompanyDescription(Base):
     city = Column(Text)
     country = Column(Text)
     last_update = Column(Date)
+    services_mask = Column(Bitmask)         # provided services, cf. ServiceGrid (ACPR or CB grid after auth_type)
+    activities_mask = Column(Integer)       # authorized activities, cf. activityBit
+    # both of them translated to the ACPR grid once and for all, cf. domesticate: what companies are screened on
+    acpr_services_mask = Column(Integer)
+    acpr_activities_mask = Column(Integer)
 
     __mapper_args__ = {'polymorphic_on': type,
                        'with_polymorphic': '*'}
@@ -85,7 +116,7 @@ class CompanyDescription(Base):
 class AuthorizedActivity(Base):
     __tablename__ = 'authorized_activities'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    cib = Column(Integer, ForeignKey("companies.cib"), nullable=False)
+    cib = Column(Integer, ForeignKey("companies.cib"), nullable=False, index=True)
     activity = Column(Integer, nullable=False)
 
     company = relationship("CompanyDescription", back_populates="authorized_activities")
@@ -106,7 +137,7 @@ class AuthorizedActivity(Base):
 class ProvidedService(Base):
     __tablename__ = 'provided_services'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    cib = Column(Integer, ForeignKey("companies.cib"), nullable=False)
+    cib = Column(Integer, ForeignKey("companies.cib"), nullable=False, index=True)
     service = Column(Integer, nullable=False)
     instrument = Column(Integer, nullable=False)
 
@@ -147,6 +178,28 @@ class ProvidedService(Base):
         return hash((self.service, self.instrument))
 
 
+class IngestedPage(Base):
+    """ Manifest of the raw pages regasniff went through, to only parse again those which changed """
+    __tablename__ = 'ingested_pages'
+    STORED = 'stored'
+    SKIPPED = 'skipped'         # parsed, but not a company we keep
+    FAILED = 'failed'           # parsed again on next run whatever happens
+
+    cib = Column(Text, primary_key=True)            # as named in the raw store
+    content_hash = Column(Text, nullable=False)
+    mtime = Column(Float)
+    status = Column(Text, nullable=False)
+
+
+# Rules of a screening, compiled for SQLite to score companies (cf. RegafiDBSession.topScores): each of them adds its
+# weight to companies whose profile has one of its bits. Temporary, it only lives as long as the connection.
+SCREENING_RULES = Table('screening_rules', MetaData(),
+                        Column('services_bit', Integer, nullable=False),         # cf. acpr_services_mask
+                        Column('activities_bit', Integer, nullable=False),       # cf. acpr_activities_mask
+                        Column('weight', Integer, nullable=False),
+                        prefixes=['TEMPORARY'])
+
+
 class ACPR_authorized_activity(Base):
     __tablename__ = 'ACPR_authorized_activities'
     activity = Column(Integer, primary_key=True)
@@ -182,12 +235,172 @@ class RegafiDBSession(sessionmaker):
         self.db = database
         db_exists = os.path.exists(self.db)
         if reset and db_exists:
-            os.remove(DATABASE)
+            # a journal left by a bulk load must not outlive its database
+            for filename in (self.db, self.db + '-wal', self.db + '-shm'):
+                if os.path.exists(filename):
+                    os.remove(filename)
         self.engine = create_engine('sqlite:///' + self.db)
         super().__init__(bind=self.engine)
         Base.metadata.create_all(self.engine)
         if reset or not db_exists:
             self._fill_legends()
+        else:
+            self._upgrade()
+
+    def _upgrade(self):
+        """ Adds the indexes and the columns databases built by earlier versions lack, create_all only creating missing
+            tables. The values of the columns being unknown, the manifest is then emptied so that the next regasniff
+            parses every page again. """
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+        columns = {column['name'] for column in inspect(self.engine).get_columns(CompanyDescription.__tablename__)}
+        missing = [column for column in CompanyDescription.__table__.columns if column.name not in columns]
+        if not missing:
+            return
+        with self.engine.begin() as connection:
+            for column in missing:
+                connection.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    CompanyDescription.__tablename__, column.name, column.type.compile(self.engine.dialect)))
+            connection.execute(IngestedPage.__table__.delete())
+
+    def bulkLoad(self, pages, batchSize=BULK_BATCH_SIZE, synchronous='NORMAL', replace=False, stats=None):
+        """ Inserts companies without going through the ORM: one executemany per table and per batch of batchSize
+            pages, each batch in its own transaction together with the manifest entries of its pages. The database is
+            switched to WAL journaling, and to the given synchronous level for the time of the load.
+            :param pages: (manifest entry, record) for each page parsed, the entry being a dict of IngestedPage columns
+                and the record the company as returned by Company.toRecord, or None
+            :param replace: whether the companies of these pages may already be there, to be replaced
+            :param stats: RegaStats.RunStats timing each batch as the 'save' stage
+            :return the number of companies inserted
+        """
+        count = 0
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+                connection.exec_driver_sql('PRAGMA synchronous=%s' % synchronous)
+
+            batch = []
+            for page in pages:
+                batch.append(page)
+                if len(batch) >= batchSize:
+                    with stats.time('save') if stats else contextlib.nullcontext():
+                        count += self._storeBatch(connection, batch, replace)
+                    batch = []
+            with stats.time('save') if stats else contextlib.nullcontext():
+                count += self._storeBatch(connection, batch, replace)
+
+            with connection.begin():
+                connection.exec_driver_sql('PRAGMA synchronous=FULL')
+        return count
+
+    def loadManifest(self):
+        """ :return dict CIB -> IngestedPage for every page ingested so far """
+        session = self()
+        manifest = {entry.cib: entry for entry in session.query(IngestedPage)}
+        session.expunge_all()
+        session.close()
+        return manifest
+
+    def touchManifest(self, mtimes):
+        """ Records new modification times of pages whose content did not change
+            :param mtimes: dict CIB -> mtime
+        """
+        if not mtimes:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(IngestedPage.__table__.update().where(IngestedPage.cib == bindparam('page'))
+                               .values(mtime=bindparam('new_mtime')),
+                               [{'page': cib, 'new_mtime': mtime} for cib, mtime in mtimes.items()])
+
+    def bulkDelete(self, cibs):
+        """ Removes the companies of the given pages, and the pages from the manifest """
+        cibs = list(cibs)
+        with self.engine.begin() as connection:
+            for n in range(0, len(cibs), BULK_BATCH_SIZE):
+                batch = cibs[n:n + BULK_BATCH_SIZE]
+                self._deleteCompanies(connection, [int(cib) for cib in batch])
+                connection.execute(IngestedPage.__table__.delete().where(IngestedPage.cib.in_(batch)))
+
+    @staticmethod
+    def queryCompanies(session):
+        """ :return a query on companies loading their services and activities along with them: one more SELECT for
+            each collection per batch of companies, instead of one per company as soon as they are printed """
+        return session.query(CompanyDescription).options(selectinload(CompanyDescription.provided_services),
+                                                         selectinload(CompanyDescription.authorized_activities))
+
+    @staticmethod
+    def topScores(connection, rules, n):
+        """ Scores companies inside SQLite, from their profile, without loading any of them
+            :param rules: dicts of SCREENING_RULES columns
+            :return [(cib, score)] of the n best companies, best first, then by decreasing CIB as Screener.print does
+        """
+        companies = CompanyDescription.__table__
+        missing = connection.execute(select(func.count()).where(companies.c.acpr_services_mask.is_(None))).scalar()
+        if missing:
+            raise ValueError("%d companies have no profile, run regasniff to parse them again" % missing)
+
+        SCREENING_RULES.create(connection, checkfirst=True)
+        connection.execute(SCREENING_RULES.delete())
+        if rules:
+            connection.execute(SCREENING_RULES.insert(), rules)
+        matches = (companies.c.acpr_services_mask.op('&')(SCREENING_RULES.c.services_bit) +
+                   companies.c.acpr_activities_mask.op('&')(SCREENING_RULES.c.activities_bit)) != 0
+        score = func.coalesce(func.sum(SCREENING_RULES.c.weight), 0).label('score')
+        query = select(companies.c.cib, score) \
+            .select_from(companies.outerjoin(SCREENING_RULES, matches)) \
+            .group_by(companies.c.cib) \
+            .order_by(score.desc(), companies.c.cib.desc()) \
+            .limit(n)
+        return [tuple(row) for row in connection.execute(query)]
+
+    @staticmethod
+    def _storeBatch(connection, pages, replace):
+        """ Inserts a batch of pages, then one page at a time if one of them breaks a constraint: a bad record only
+            fails its own page, recorded as FAILED in the manifest so that it is parsed again on next run
+            :return the number of companies inserted
+        """
+        try:
+            return RegafiDBSession._insertBatch(connection, pages, replace)
+        except IntegrityError:
+            if len(pages) == 1:
+                raise
+        count = 0
+        for entry, record in pages:
+            try:
+                count += RegafiDBSession._insertBatch(connection, [(entry, record)], replace)
+            except IntegrityError as e:
+                RegaLog.logger.error("[CIB: {}] Unable to store the company ({})".format(entry['cib'], e.orig))
+                RegafiDBSession._insertBatch(connection, [(dict(entry, status=IngestedPage.FAILED), None)], replace)
+        return count
+
+    @staticmethod
+    def _insertBatch(connection, pages, replace):
+        """ :return the number of companies inserted """
+        entries, companies, services, activities = [], [], [], []
+        for entry, record in pages:
+            entries.append(entry)
+            if record is not None:
+                properties, provided, authorized = record
+                companies.append(properties)
+                services += [{'cib': properties['cib'], 'service': service, 'instrument': instrument}
+                             for service, instrument in provided]
+                activities += [{'cib': properties['cib'], 'activity': activity} for activity in authorized]
+        with connection.begin():
+            if replace:
+                RegafiDBSession._deleteCompanies(connection, [int(entry['cib']) for entry in entries])
+            for table, rows in ((CompanyDescription.__table__, companies), (ProvidedService.__table__, services),
+                                (AuthorizedActivity.__table__, activities)):
+                if rows:
+                    connection.execute(table.insert(), rows)
+            if entries:
+                connection.execute(IngestedPage.__table__.insert().prefix_with('OR REPLACE'), entries)
+        return len(companies)
+
+    @staticmethod
+    def _deleteCompanies(connection, cibs):
+        for table in (ProvidedService.__table__, AuthorizedActivity.__table__, CompanyDescription.__table__):
+            connection.execute(table.delete().where(table.c.cib.in_(cibs)))
 
     def _fill_legends(self):
         session = self()
@@ -285,3 +498,191 @@ class Legend(object):
     @staticmethod
     def getCBInstruments():
         return Legend.CB_instruments
+
+
+class ServiceGrid(object):
+    """ A services grid as laid out on regafi pages. Each (service, instrument) cell gets the bit of its position on the
+        page, so that the services a company provides fit in a single integer.
+    """
+    def __init__(self, services, instruments, byService):
+        """ :param services: legend of the services (rows or columns of the grid), and likewise for instruments
+            :param byService: whether the page lists all the instruments of a service before the next service
+        """
+        self.services = len(services)
+        self.instruments = len(instruments)
+        self.size = self.services * self.instruments
+        self.byService = byService
+        self.serviceHeadings = {normalizeHeading(name): service for service, name in services.items()}
+        self.instrumentHeadings = {normalizeHeading(name): instrument for instrument, name in instruments.items()}
+        self.layouts = dict()
+
+    def __contains__(self, cell):
+        service, instrument = cell
+        return 1 <= service <= self.services and 1 <= instrument <= self.instruments
+
+    def bit(self, service, instrument):
+        if (service, instrument) not in self:
+            raise ValueError("No cell (%s, %s) in a %dx%d grid" % (service, instrument, self.services, self.instruments))
+        if self.byService:
+            return 1 << ((service - 1) * self.instruments + instrument - 1)
+        return 1 << ((instrument - 1) * self.services + service - 1)
+
+    def mask(self, cells):
+        """ :param cells: (service, instrument) pairs """
+        mask = 0
+        for service, instrument in cells:
+            mask |= self.bit(service, instrument)
+        return mask
+
+    def cellAt(self, position):
+        """ :return (service, instrument) of the cell at position (from 0) on the page """
+        if self.byService:
+            return position // self.instruments + 1, position % self.instruments + 1
+        return position % self.services + 1, position // self.services + 1
+
+    def cells(self, mask):
+        """ :return the (service, instrument) pairs of the bits set in mask, in the order of the page """
+        cells = []
+        position = 0
+        while mask:
+            if mask & 1:
+                cells.append(self.cellAt(position))
+            mask >>= 1
+            position += 1
+        return cells
+
+    def decode(self, headings, cells, cib=None):
+        """ Finds the service and instrument of each cell of the grid from the headings the cell refers to (its headers
+            attribute), so that the order of the cells does not matter. Falls back on their position, with a warning,
+            if any cell cannot be placed this way.
+            :param headings: dict id -> text of the headings of the grid
+            :param cells: (ticked, headers attribute of the cell) for every cell, in the order of the page
+            :param cib: of the page, for the warning
+            :return (service, instrument) of the ticked cells
+        """
+        # pages laid out alike have the same headings: their cells are only placed once
+        key = frozenset(headings.items())
+        layout = self.layouts.get(key)
+        if layout is None:
+            if len(self.layouts) >= MAX_GRID_LAYOUTS:
+                self.layouts.clear()
+            layout = self.layouts[key] = GridLayout(self, headings)
+
+        placed = [layout.place(headers) for ticked, headers in cells]
+        if None in placed or len(set(placed)) != len(placed):
+            RegaLog.logger.warning("[CIB: {}] {} cells of the services grid do not match its headings, decoding them by "
+                                   "position".format(cib, len(placed) - len(set(placed) - {None})))
+            placed = [self.cellAt(position) for position in range(len(cells))]
+        return [cell for cell, (ticked, headers) in zip(placed, cells) if ticked]
+
+
+class GridLayout(object):
+    """ Where the cells of a ServiceGrid are, given the headings of a page """
+    def __init__(self, grid, headings):
+        self.services = dict()
+        self.instruments = dict()
+        self.cells = dict()
+        for id, text in headings.items():
+            text = normalizeHeading(text)
+            if text in grid.serviceHeadings:
+                self.services[id] = grid.serviceHeadings[text]
+            elif text in grid.instrumentHeadings:
+                self.instruments[id] = grid.instrumentHeadings[text]
+
+    def place(self, headers):
+        """ :param headers: headers attribute of a cell, ids of its headings separated by spaces
+            :return (service, instrument) of the cell, None if it does not refer to both
+        """
+        try:
+            return self.cells[headers]
+        except KeyError:
+            pass
+        ids = headers.split()
+        service = next((self.services[id] for id in ids if id in self.services), None)
+        instrument = next((self.instruments[id] for id in ids if id in self.instruments), None)
+        cell = self.cells[headers] = None if service is None or instrument is None else (service, instrument)
+        return cell
+
+
+def normalizeHeading(heading):
+    return ' '.join(heading.split()).casefold() if heading else None
+
+
+def activityBit(activity):
+    return 1 << (activity - 1)
+
+
+def activitiesMask(activities):
+    mask = 0
+    for activity in activities:
+        mask |= activityBit(activity)
+    return mask
+
+
+ACPR_GRID = ServiceGrid(Legend.getACPRServices(), Legend.getACPRInstruments(), byService=True)
+CB_GRID = ServiceGrid(Legend.getCBServices(), Legend.getCBInstruments(), byService=False)
+
+
+CB_TO_ACPR_INSTRUMENTS_MATCHER = {
+    1: [1, 2],
+    2: [5],
+    3: [3],
+    4: [4],
+    5: [2, 9],
+    6: [4],
+    7: [4],
+    8: [4],
+    9: [5],
+    10: [4]
+}
+
+CB_SERVICES_TO_ACPR_SERVICES_MATCHER = {
+    1: [1],
+    2: [2],
+    3: [3],
+    4: [4],
+    5: [5],
+    6: [6, 7],
+    7: [8],
+    8: [9]
+}
+
+CB_SERVICES_TO_ACPR_ACTIVITIES_MATCHER = {
+    9: [3]
+}
+
+
+def buildDomesticationTable():
+    """ :return for each cell of the CB grid, in the order of its bits, the (services mask over the ACPR grid,
+        activities mask) it stands for. Services matched to activities (CB_SERVICES_TO_ACPR_ACTIVITIES_MATCHER) are
+        not translated: the screener has never scored them. """
+    table = []
+    for position in range(CB_GRID.size):
+        service, instrument = CB_GRID.cellAt(position)
+        services = 0
+        for domesticatedService in CB_SERVICES_TO_ACPR_SERVICES_MATCHER.get(service, []):
+            for domesticatedInstrument in CB_TO_ACPR_INSTRUMENTS_MATCHER[instrument]:
+                if (domesticatedService, domesticatedInstrument) in ACPR_GRID:
+                    services |= ACPR_GRID.bit(domesticatedService, domesticatedInstrument)
+        table.append((services, 0))
+    return table
+
+
+DOMESTICATION_TABLE = buildDomesticationTable()
+
+
+def domesticate(servicesMask):
+    """ Translates services of the CB grid into their ACPR equivalent
+        :return (services mask over the ACPR grid, activities mask)
+    """
+    services = 0
+    activities = 0
+    position = 0
+    while servicesMask:
+        if servicesMask & 1:
+            cellServices, cellActivities = DOMESTICATION_TABLE[position]
+            services |= cellServices
+            activities |= cellActivities
+        servicesMask >>= 1
+        position += 1
+    return services, activities
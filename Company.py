@@ -19,9 +19,10 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 import sys
-from bs4 import NavigableString
+from bs4 import NavigableString, SoupStrainer
+from sqlalchemy import inspect
 from BaseDeclarations import buildInspectEmptyDict
-from BaseDeclarations import CompanyDescription
+from BaseDeclarations import CompanyDescription, ProvidedService, activitiesMask, domesticate
 import RegaLog
 
 
@@ -34,14 +35,22 @@ NOT_PROVIDED_SERVICE_IMG = 'squelettes/img/unchecked.png'
 
 
 class Company(CompanyDescription):
+    # not mapped, only its subclasses are: the companies they load are then all known to the session as
+    # CompanyDescription, which is how services and activities find them back, cf. RegafiDBSession.queryCompanies
+    __abstract__ = True
     score = 0   # used to sort, cf. screener
+    parser = None   # set by makeFromMainDiv
+    GRID = None     # layout of the services grid, cf. BaseDeclarations.ServiceGrid
 
     @classmethod
-    def makeFromMainDiv(cls, mainDiv, cib):
+    def makeFromMainDiv(cls, mainDiv, cib, parser=None):
+        """ :param parser: how mainDiv is read, SoupParser for a BeautifulSoup tree (default), see also
+            FastExtractor.XPathParser for an lxml one """
         # Storing mainDiv in the object is meaningless (it may not be built from HTML) and useless (once processed, data
         # is stored elsewhere)
+        parser = parser or SoupParser
 
-        companyDiv = cls._findCompanyDiv(mainDiv)
+        companyDiv = parser.findCompanyDiv(mainDiv)
         if companyDiv is None:
             RegaLog.logger.error("Error while loading company description for CIB %s, skipping..." % cib)
             return None
@@ -51,14 +60,16 @@ class Company(CompanyDescription):
             properties['cib'] = int(cib)
             properties['authorized_activities'] = []
             properties['provided_services'] = []
-            cls._processCompanyDiv(companyDiv, properties)
+            cls._processCompanyDiv(companyDiv, properties, parser)
         except (ValueError, TypeError) as e:
             RegaLog.logger.error(e)
             return None
 
         company = cls._buildCompany(properties)
         if company is not None:
+            company.parser = parser
             company.process(mainDiv, cib)
+            company.updateMasks()
         return company
 
     @staticmethod
@@ -128,28 +139,20 @@ class Company(CompanyDescription):
             return None
 
     @classmethod
-    def _processCompanyDiv(cls, companyDiv, output):
-        def findLi(tag):
-            return tag.name == 'li' and not tag.has_attr('class')
-
-        def findType(tag):
-            return tag.name == 'strong' and tag.has_attr('class') and tag['class'] == ['description']
-
-        type = companyDiv.find(findType)
+    def _processCompanyDiv(cls, companyDiv, output, parser):
+        type, fields = parser.readDescription(companyDiv)
         if type is None:
             raise TypeError("No type found for company with CIB %s" % output['cib'])
 
-        output['type'] = type.contents[0].strip()
+        output['type'] = type
 
-        for descriptionLi in companyDiv.find_all(findLi):
-            cls._processLi(descriptionLi, output)
+        for key, value in fields:
+            cls._processField(key, value, output)
 
     @staticmethod
-    def _processLi(descriptionLi, output):
+    def _processField(key, value, output):
         """ Beware: may give weird results in case a field appears twice (e.g. 'Ville' for branches
             which will appear after branch address and headquarters adress)."""
-        key = descriptionLi.contents[0].strip()
-        value = descriptionLi.find('span').contents[0].strip()
         if key == 'Code banque (CIB) :':
             if int(value) != output['cib']:
                 raise ValueError("Extracted CIB does not match with value provided (%d)" % output['cib'])
@@ -176,12 +179,12 @@ class Company(CompanyDescription):
         elif key == 'Pays :':
             output['country'] = value
 
-    @staticmethod
-    def _findCompanyDiv(mainDiv):
-        def findCompanyDiv(tag):
-            return tag.name == 'div' and tag.has_attr('id') and tag['id'] == COMPANY_DIV_ID
-
-        return mainDiv.find(findCompanyDiv)
+    def toRecord(self):
+        """ :return the company as plain, picklable data: (columns, [(service, instrument)], [activity]) """
+        properties = {column.key: getattr(self, column.key) for column in inspect(CompanyDescription).column_attrs}
+        # as in _buildActivitiesMask, activities missing from the legend are left out
+        return properties, [(service.service, service.instrument) for service in self.provided_services], \
+               [activity.activity for activity in self.authorized_activities if activity.activity is not None]
 
     def process(self, mainDiv, cib):
         # fallback
@@ -193,6 +196,42 @@ class Company(CompanyDescription):
     def getActivities(self):
         return self.authorized_activities
 
+    def updateMasks(self):
+        """ Encodes provided services and authorized activities into services_mask and activities_mask, and the
+            profile of the company """
+        self.services_mask = self._buildServicesMask()
+        self.activities_mask = self._buildActivitiesMask()
+        self.acpr_services_mask, self.acpr_activities_mask = self._buildProfile()
+
+    def getServicesMask(self):
+        """ :return provided services as a bitmask over the grid of the company (see ServiceGrid) """
+        if self.services_mask is None:      # stored before masks existed
+            return self._buildServicesMask()
+        return self.services_mask
+
+    def getActivitiesMask(self):
+        if self.activities_mask is None:
+            return self._buildActivitiesMask()
+        return self.activities_mask
+
+    def getProfile(self):
+        """ :return (services mask over the ACPR grid, activities mask) the company is screened on """
+        if self.acpr_services_mask is None:
+            return self._buildProfile()
+        return self.acpr_services_mask, self.acpr_activities_mask
+
+    def _buildProfile(self):
+        # services provided under another regime are translated into their ACPR equivalent
+        return domesticate(self.getServicesMask())
+
+    def _buildServicesMask(self):
+        if self.GRID is None:
+            return 0
+        return self.GRID.mask((service.service, service.instrument) for service in self.provided_services)
+
+    def _buildActivitiesMask(self):
+        return activitiesMask(activity.activity for activity in self.authorized_activities if activity.activity is not None)
+
     def save(self, session):
         session.add(self)
         # for activity in self._activities:
@@ -215,21 +254,86 @@ class Company(CompanyDescription):
 
 
     def _retrieveInvestmentServices(self, frenchActivitiesDiv, cib):
-        # fallback
-        pass
+        try:
+            services = self._findInvestmentServices(frenchActivitiesDiv)
+        except (ValueError, ParsingError) as e:
+            RegaLog.logger.error("[CIB: {}] {}".format(cib, e))
+            return
+
+        for service, instrument in services:
+            self.provided_services.add(ProvidedService(cib=int(cib), service=service, instrument=instrument))
 
     def _retrieveAuthorizedActivities(self, frenchActivitiesDiv, number, cib):
         # fallback
         pass
 
     def _findFrenchActivitiesDiv(self, mainDiv):
+        return self.parser.findFrenchActivitiesDiv(mainDiv)
+
+    def _findInvestmentServices(self, frenchActivitiesDiv):
+        """ :return (service, instrument) of the services provided, read from the grid of the company """
+        headings, cells = self.parser.readServicesGrid(frenchActivitiesDiv)
+        if len(cells) != self.GRID.size:
+            raise ValueError("%d services retrieved instead of %d" % (len(cells), self.GRID.size))
+        return self.GRID.decode(headings, cells, self.cib)
+
+    def _findAuthorizedActivities(self, frenchActivitiesDiv):
+        """ :return (authorized, name of the activity) for each activity listed """
+        return self.parser.readAuthorizedActivities(frenchActivitiesDiv)
+
+    #todo maube not useful
+    def __eq__(self, other):
+        return self.score == other.score
+
+    def __lt__(self, other):
+        return self.score < other.score
+
+    def __le__(self, other):
+        return self.score <= other.score
+
+
+class SoupParser(object):
+    """ Reads the parts of a firm description Company needs from a BeautifulSoup tree """
+    # to build a tree of those parts only: BeautifulSoup(page, "lxml", parse_only=SoupParser.STRAINER)
+    STRAINER = SoupStrainer('div', id=[COMPANY_DIV_ID, FRENCH_ACTIVITIES_DIV_ID])
+
+    @staticmethod
+    def findCompanyDiv(mainDiv):
+        def findCompanyDiv(tag):
+            return tag.name == 'div' and tag.has_attr('id') and tag['id'] == COMPANY_DIV_ID
+
+        return mainDiv.find(findCompanyDiv)
+
+    @staticmethod
+    def readDescription(companyDiv):
+        """ :return (type, [(key, value) for each field of the description]), type being None if not found """
+        def findLi(tag):
+            return tag.name == 'li' and not tag.has_attr('class')
+
+        def findType(tag):
+            return tag.name == 'strong' and tag.has_attr('class') and tag['class'] == ['description']
+
+        type = companyDiv.find(findType)
+        if type is None:
+            return None, []
+
+        fields = [(descriptionLi.contents[0].strip(), descriptionLi.find('span').contents[0].strip())
+                  for descriptionLi in companyDiv.find_all(findLi)]
+        return type.contents[0].strip(), fields
+
+    @staticmethod
+    def findFrenchActivitiesDiv(mainDiv):
         def findFrenchActivitiesDiv(tag):
             return tag.name == 'div' and tag.has_attr('id') and tag['id'] == FRENCH_ACTIVITIES_DIV_ID
 
         return mainDiv.find(findFrenchActivitiesDiv)
 
-    def _findInvestmentServices(self, frenchActivitiesDiv, number):
-        """ find in two steps not necessary but cleaner from a semantic point of view """
+    @staticmethod
+    def readServicesGrid(frenchActivitiesDiv):
+        """ Reads the services table in a single pass over its headings and cells
+            :return (dict id -> text of each heading, [(ticked, headers attribute of the cell) for each cell in the order
+                of the page])
+        """
         def findServiceTable(tag):
             if tag.name != 'table':
                 return False
@@ -237,17 +341,10 @@ class Company(CompanyDescription):
                 return False
             return tag['class'] == SERVICES_TABLE_CLASS and tag['summary'] == SERVICES_TABLE_SUMMARY
 
-        servicesTable = frenchActivitiesDiv.find(findServiceTable)
-        if servicesTable is None:
-            raise ParsingError("Error while parsing CB services")
-
-        return self._makeInvestmentServicesList(servicesTable, number)
-
-    def _makeInvestmentServicesList(self, servicesTable, number):
-        def findServiceTd(tag):
-            if tag.name != 'td':
-                return False
-            if not tag.has_attr('headers'):
+        def findGridTag(tag):
+            if tag.name == 'th':
+                return tag.has_attr('id')
+            if tag.name != 'td' or not tag.has_attr('headers'):
                 return False
             nexttag = tag
             while nexttag.next_element is not None and isinstance(nexttag.next_element, NavigableString):
@@ -256,20 +353,36 @@ class Company(CompanyDescription):
                 return False
             return nexttag.next_element['src'] == PROVIDED_SERVICE_IMG or nexttag.next_element['src'] == NOT_PROVIDED_SERVICE_IMG
 
-        serviceTds = servicesTable.find_all(findServiceTd)
-        if len(serviceTds) != number:
-            raise ValueError("%d services retrieved instead of %d" % (len(serviceTds), number))
-        return serviceTds
-
-    #todo maube not useful
-    def __eq__(self, other):
-        return self.score == other.score
+        servicesTable = frenchActivitiesDiv.find(findServiceTable)
+        if servicesTable is None:
+            raise ParsingError("Error while parsing CB services")
 
-    def __lt__(self, other):
-        return self.score < other.score
+        headings = dict()
+        cells = []
+        for tag in servicesTable.find_all(findGridTag):
+            if tag.name == 'th':
+                headings[tag['id']] = tag.get_text()
+            else:
+                headers = tag['headers']
+                cells.append((tag.find('img')['src'] == PROVIDED_SERVICE_IMG,
+                              headers if isinstance(headers, str) else ' '.join(headers)))
+        return headings, cells
 
-    def __le__(self, other):
-        return self.score <= other.score
+    @staticmethod
+    def readAuthorizedActivities(frenchActivitiesDiv):
+        def findActivitiesTables(tag):
+            if tag.name != 'table':
+                return False
+            if tag.has_attr('class') or not tag.has_attr('summary'):
+                return False
+            return tag['summary'] == ''
+
+        activities = []
+        for table in frenchActivitiesDiv.find_all(findActivitiesTables):
+            for activityTr in table.find_all('tr'):
+                tds = activityTr.find_all('td')
+                activities.append((tds[0].find('img')['src'] == PROVIDED_SERVICE_IMG, tds[1].contents[0].strip()))
+        return activities
 
 
 class ParsingError(Exception):
@@ -0,0 +1,188 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import time
+import random
+import threading
+import http.client
+from email.utils import parsedate_to_datetime
+from RegaHTTP import HTTPError
+import RegaLog
+
+
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE = 0.5              # seconds, doubled at each attempt
+BACKOFF_CAP = 30
+LATENCY_FACTOR = 2.0            # latency above this many times the best one observed means the server is struggling
+ERROR_RATE_THRESHOLD = 0.1      # so does a proportion of transient errors above this one
+DECREASE_FACTOR = 0.5
+EWMA_WEIGHT = 0.1
+ERROR_EWMA_WEIGHT = 0.02        # errors are averaged over a longer window, a single one must not halve the limit
+WARM_UP = 10                    # requests before the moving averages are trusted
+BREAKER_THRESHOLD = 10          # consecutive failures
+BREAKER_COOLDOWN = 30           # seconds, doubled each time the breaker trips again
+BREAKER_MAX_COOLDOWN = 600
+
+
+def isTransient(error):
+    if isinstance(error, HTTPError):
+        return error.status in TRANSIENT_STATUSES
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+
+def retryAfter(error):
+    """ :return the delay asked by the server in a Retry-After header, in seconds, or 0 """
+    value = getattr(error, 'headers', {}).get('retry-after')
+    if value is None:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
+
+
+class AdaptiveController(object):
+    """ Decides how many requests may be in flight, AIMD-style: the limit grows by one every `limit` successful
+        requests and is halved (at most once per round-trip) when the moving average of the latency drifts above
+        LATENCY_FACTOR times the best average observed, or when the moving proportion of transient errors exceeds
+        ERROR_RATE_THRESHOLD.
+        Transient failures are retried with exponential backoff and full jitter. After BREAKER_THRESHOLD consecutive
+        failures the circuit breaker opens: requests wait for the cooldown, then a single probe is let through, and
+        the crawl resumes only once it succeeds. Nothing is skipped, the crawl just waits for the site to recover.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, maxLimit, minLimit=1, initialLimit=None, maxRetries=DEFAULT_MAX_RETRIES, seed=None):
+        self.maxLimit = max(maxLimit, minLimit)
+        self.minLimit = minLimit
+        self.limit = float(initialLimit or max(minLimit, maxLimit // 2))
+        self.maxRetries = maxRetries
+        self.random = random.Random(seed)
+        self.condition = threading.Condition()
+        self.inFlight = 0
+        self.requests = 0
+        self.latency = None         # moving averages
+        self.bestLatency = None
+        self.errorRate = 0
+        self.lastDecrease = 0
+        self.consecutiveFailures = 0
+        self.state = AdaptiveController.CLOSED
+        self.openUntil = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.retries = 0
+        self.trips = 0
+
+    def call(self, function, throttle=None):
+        """ Runs `function` (a request) when the limit allows it, retrying it on transient errors
+            :param throttle: called before each attempt, before waiting for the limit, e.g. RateLimiter.wait: the time
+                spent there is neither counted as latency nor holds a slot
+            :return what `function` returns
+        """
+        attempt = 0
+        while True:
+            if throttle is not None:
+                throttle()
+            self._acquire()
+            start = time.monotonic()
+            try:
+                result = function()
+            except Exception as e:
+                transient = isTransient(e)
+                # a non transient error (e.g. 404) is a valid answer as far as congestion is concerned
+                self._release(time.monotonic() - start, success=not transient)
+                if not transient or attempt >= self.maxRetries:
+                    raise
+                with self.condition:
+                    self.retries += 1
+                delay = max(retryAfter(e), self.random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+                RegaLog.logger.info("Transient error (%s), retrying in %.1fs" % (e, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._release(time.monotonic() - start, success=True)
+            return result
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.state == AdaptiveController.OPEN:
+                    if now < self.openUntil:
+                        self.condition.wait(self.openUntil - now)
+                        continue
+                    self.state = AdaptiveController.HALF_OPEN
+                if self.state == AdaptiveController.HALF_OPEN:
+                    # a single probe at a time until the server answers again
+                    if self.inFlight == 0:
+                        self.inFlight += 1
+                        return
+                elif self.inFlight < int(self.limit):
+                    self.inFlight += 1
+                    return
+                self.condition.wait()
+
+    def _release(self, latency, success):
+        with self.condition:
+            self.inFlight -= 1
+            self.requests += 1
+            now = time.monotonic()
+            self.errorRate = (1 - ERROR_EWMA_WEIGHT) * self.errorRate + ERROR_EWMA_WEIGHT * (0 if success else 1)
+            if success:
+                self.consecutiveFailures = 0
+                if self.state == AdaptiveController.HALF_OPEN:
+                    RegaLog.logger.warning("Circuit breaker closed, resuming the crawl")
+                    self.state = AdaptiveController.CLOSED
+                    self.cooldown = BREAKER_COOLDOWN
+                self.latency = latency if self.latency is None else \
+                    (1 - EWMA_WEIGHT) * self.latency + EWMA_WEIGHT * latency
+                if self.requests >= WARM_UP:
+                    self.bestLatency = self.latency if self.bestLatency is None else min(self.bestLatency, self.latency)
+            else:
+                self.consecutiveFailures += 1
+                if self.state == AdaptiveController.HALF_OPEN or self.consecutiveFailures >= BREAKER_THRESHOLD:
+                    self._trip(now)
+
+            if self.errorRate > ERROR_RATE_THRESHOLD or \
+                    (self.bestLatency is not None and self.latency > LATENCY_FACTOR * self.bestLatency):
+                self._decrease(now)
+            elif success:
+                self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def _decrease(self, now):
+        if now - self.lastDecrease < (self.latency or 0):
+            return
+        self.lastDecrease = now
+        self.limit = max(self.minLimit, self.limit * DECREASE_FACTOR)
+
+    def _trip(self, now):
+        RegaLog.logger.warning("Circuit breaker opened after %d failures, pausing for %ds"
+                               % (self.consecutiveFailures, self.cooldown))
+        self.state = AdaptiveController.OPEN
+        self.openUntil = now + self.cooldown
+        self.cooldown = min(BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+        self.consecutiveFailures = 0
+        self.trips += 1
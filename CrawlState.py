@@ -0,0 +1,356 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import hashlib
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, Float, Boolean, Text, DateTime
+
+
+CRAWL_DATABASE = 'crawl.db'
+CrawlBase = declarative_base()      # kept apart from results.db, which regasniff may delete at will
+
+
+class SearchURI(CrawlBase):
+    __tablename__ = 'search_uris'
+    cib = Column(Text, primary_key=True)        # CIB or registration number, as found in the export
+    uri = Column(Text, nullable=False)
+
+
+class JournalColumns(object):
+    cib = Column(Text, primary_key=True)
+    status = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    updated = Column(DateTime)
+
+
+class JournalEntry(JournalColumns, CrawlBase):
+    __tablename__ = 'crawl_journal'
+
+
+class PipelineJournalEntry(JournalColumns, CrawlBase):
+    """ Journal of regapipe, kept apart from the crawl one: a firm is done there once stored in results.db, not once
+        its page is saved """
+    __tablename__ = 'pipeline_journal'
+
+
+class ExportRow(CrawlBase):
+    __tablename__ = 'export_rows'
+    cib = Column(Text, primary_key=True)
+    row_hash = Column(Text, nullable=False)     # digest of the whole line of regafi_export.csv
+
+
+class PageState(CrawlBase):
+    __tablename__ = 'page_states'
+    cib = Column(Text, primary_key=True)
+    content_hash = Column(Text, nullable=False)     # digest of the description and activities divs only
+    checked = Column(DateTime, nullable=False)      # stored as UTC
+    changed = Column(DateTime, nullable=False)
+
+
+class PageChange(CrawlBase):
+    """ Journal of the pages that actually changed, for the downstream stages to act on just those """
+    __tablename__ = 'page_changes'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cib = Column(Text, nullable=False)
+    change = Column(Text, nullable=False)
+    detected = Column(DateTime, nullable=False)
+
+
+class WorkItem(CrawlBase):
+    """ One line of the work list, see WorkList """
+    __tablename__ = 'work_list'
+    position = Column(Integer, primary_key=True, autoincrement=False)
+    cib = Column(Text, nullable=False, unique=True)
+    row_hash = Column(Text, nullable=False)
+    agent = Column(Boolean, nullable=False)
+    sector = Column(Text, nullable=False)
+
+
+class WorkListSource(CrawlBase):
+    """ The export the work list was built from, to know when to build it again """
+    __tablename__ = 'work_list_source'
+    path = Column(Text, primary_key=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+
+
+class CrawlDBSession(sessionmaker):
+    def __init__(self, database=CRAWL_DATABASE):
+        self.db = database
+        self.engine = create_engine('sqlite:///' + self.db)
+        super().__init__(bind=self.engine)
+        CrawlBase.metadata.create_all(self.engine)
+
+
+class SearchURICache(object):
+    """ Regafi internal ids are stable, so the search URI found for a CIB during a crawl is kept for the next ones and
+        the advanced search can be skipped. Entries are written through to the database as soon as they are known
+        (without a database, the cache only lives as long as the crawl).
+    """
+    def __init__(self, DBSession=None):
+        self.DBSession = DBSession
+        self.lock = threading.Lock()
+        self.uris = dict()
+        if DBSession is not None:
+            session = DBSession()
+            self.uris = {entry.cib: entry.uri for entry in session.query(SearchURI)}
+            session.close()
+
+    def get(self, cib):
+        return self.uris.get(cib)
+
+    def put(self, cib, uri):
+        with self.lock:
+            if self.uris.get(cib) == uri:
+                return
+            self.uris[cib] = uri
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.merge(SearchURI(cib=cib, uri=uri))
+            session.commit()
+            session.close()
+
+    def putAll(self, uris):
+        """ Same as put for a whole dict CIB -> URI, in a single transaction """
+        with self.lock:
+            uris = {cib: uri for cib, uri in uris.items() if self.uris.get(cib) != uri}
+            self.uris.update(uris)
+            if self.DBSession is None or not uris:
+                return
+            session = self.DBSession()
+            for cib, uri in uris.items():
+                session.merge(SearchURI(cib=cib, uri=uri))
+            session.commit()
+            session.close()
+
+    def invalidate(self, cib):
+        with self.lock:
+            if self.uris.pop(cib, None) is None or self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.query(SearchURI).filter(SearchURI.cib == cib).delete()
+            session.commit()
+            session.close()
+
+
+class CrawlJournal(object):
+    """ Records the status of every CIB of a crawl, so that an interrupted crawl can be resumed where it stopped.
+        Each status change is committed on its own: a crash never loses more than the downloads in flight, which are
+        left 'pending' and thus downloaded again on restart. Without a database, the journal is kept in memory only.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, DBSession=None, restart=False, entry=JournalEntry):
+        """ :param entry: the table the journal is kept in, e.g. PipelineJournalEntry """
+        self.DBSession = DBSession
+        self.entry = entry
+        self.lock = threading.Lock()
+        self.statuses = dict()
+        if DBSession is not None:
+            session = DBSession()
+            if restart:
+                session.query(self.entry).delete()
+                session.commit()
+            self.statuses = {entry.cib: entry.status for entry in session.query(self.entry)}
+            session.close()
+
+    def isDone(self, cib):
+        return self.statuses.get(cib) == CrawlJournal.DONE
+
+    def remaining(self, cibs):
+        """ Filters out the CIBs already downloaded, failed and pending ones are given another chance """
+        for cib in cibs:
+            if not self.isDone(cib):
+                yield cib
+
+    def markPending(self, cib):
+        self._mark(cib, CrawlJournal.PENDING)
+
+    def markDone(self, cib):
+        self._mark(cib, CrawlJournal.DONE)
+
+    def markFailed(self, cib):
+        self._mark(cib, CrawlJournal.FAILED)
+
+    def clear(self):
+        """ To be called once a crawl is complete, so that the next one starts from scratch """
+        with self.lock:
+            self.statuses = dict()
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.query(self.entry).delete()
+            session.commit()
+            session.close()
+
+    def count(self, status):
+        return sum(1 for s in self.statuses.values() if s == status)
+
+    def _mark(self, cib, status):
+        with self.lock:
+            self.statuses[cib] = status
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            entry = session.query(self.entry).filter(self.entry.cib == cib).first()
+            if entry is None:
+                entry = self.entry(cib=cib, attempts=0)
+                session.add(entry)
+            if status == CrawlJournal.PENDING:
+                entry.attempts += 1
+            entry.status = status
+            entry.updated = datetime.now()
+            session.commit()
+            session.close()
+
+
+def hashRow(row):
+    return hashlib.sha1(';'.join(row).encode('utf-8')).hexdigest()
+
+
+def hashZones(zones):
+    """ :param zones: the parts of a page that matter, as strings """
+    return hashlib.sha1(''.join(zones).encode('utf-8')).hexdigest()
+
+
+class RefreshState(object):
+    """ Remembers what the previous crawls saw, both in the export (one digest per line) and on regafi.fr (one digest
+        of the meaningful part of each page), so that a refresh crawl only downloads the firms that may have changed:
+            - firms that are new in the export or whose line changed,
+            - firms never downloaded successfully,
+            - firms not checked for more than `maxAge`; these are fetched with If-Modified-Since.
+        Firms that disappeared from the export are reported as removed. A page whose digest did not change is not
+        reported (nor rewritten), so the `page_changes` table lists the pages that actually changed.
+    """
+    NEW = 'new'
+    CHANGED = 'changed'
+    REMOVED = 'removed'
+
+    def __init__(self, DBSession=None, maxAge=None):
+        self.DBSession = DBSession
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.rowHashes = dict()
+        self.pages = dict()         # cib -> (content_hash, checked)
+        self.revalidated = set()    # CIBs to fetch conditionally
+        if DBSession is not None:
+            session = DBSession()
+            self.rowHashes = {row.cib: row.row_hash for row in session.query(ExportRow)}
+            self.pages = {page.cib: (page.content_hash, page.checked) for page in session.query(PageState)}
+            session.close()
+
+    def plan(self, rowHashes):
+        """ :param rowHashes: iterable of (cib, digest of its line) from the current export, see WorkList
+            :return (CIBs to download, CIBs removed from the export)
+        """
+        now = datetime.utcnow()
+        toDownload = []
+        current = dict(rowHashes)
+        for cib, rowHash in current.items():
+            page = self.pages.get(cib)
+            if page is None or self.rowHashes.get(cib) != rowHash:
+                toDownload.append(cib)
+            elif self.maxAge is not None and now - page[1] > self.maxAge:
+                self.revalidated.add(cib)
+                toDownload.append(cib)
+        removed = [cib for cib in self.rowHashes if cib not in current]
+        return toDownload, removed
+
+    def modifiedSince(self, cib):
+        """ :return the value of the If-Modified-Since header to send for this CIB, or None """
+        if cib not in self.revalidated:
+            return None
+        return format_datetime(self.pages[cib][1].replace(tzinfo=timezone.utc), usegmt=True)
+
+    def hasChanged(self, cib, digest):
+        page = self.pages.get(cib)
+        return page is None or page[0] != digest
+
+    def recordPage(self, cib, digest):
+        """ :param digest: see hashZones
+            :return True if the page changed since last crawl (or is new)
+        """
+        now = datetime.utcnow()
+        with self.lock:
+            previous = self.pages.get(cib)
+            changed = previous is None or previous[0] != digest
+            self.pages[cib] = (digest, now)
+            if self.DBSession is None:
+                return changed
+            session = self.DBSession()
+            state = session.query(PageState).filter(PageState.cib == cib).first()
+            if state is None:
+                session.add(PageState(cib=cib, content_hash=digest, checked=now, changed=now))
+            else:
+                state.content_hash = digest
+                state.checked = now
+                if changed:
+                    state.changed = now
+            if changed:
+                session.add(PageChange(cib=cib, change=RefreshState.NEW if previous is None else RefreshState.CHANGED,
+                                       detected=now))
+            session.commit()
+            session.close()
+        return changed
+
+    def recordNotModified(self, cib):
+        now = datetime.utcnow()
+        with self.lock:
+            self.pages[cib] = (self.pages[cib][0], now)
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.query(PageState).filter(PageState.cib == cib).update({PageState.checked: now})
+            session.commit()
+            session.close()
+
+    def recordRemoved(self, cib):
+        with self.lock:
+            self.pages.pop(cib, None)
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.query(PageState).filter(PageState.cib == cib).delete()
+            session.add(PageChange(cib=cib, change=RefreshState.REMOVED, detected=datetime.utcnow()))
+            session.commit()
+            session.close()
+
+    def saveExport(self, rowHashes):
+        """ Remembers the export crawled, to be called once the crawl is complete
+            :param rowHashes: as in plan
+        """
+        with self.lock:
+            self.rowHashes = dict(rowHashes)
+            if self.DBSession is None:
+                return
+            session = self.DBSession()
+            session.query(ExportRow).delete()
+            session.bulk_insert_mappings(ExportRow, [{'cib': cib, 'row_hash': rowHash}
+                                                     for cib, rowHash in self.rowHashes.items()])
+            session.commit()
+            session.close()
@@ -19,15 +19,11 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 import sys
-from bs4 import NavigableString
-from Company import Company, ParsingError, PROVIDED_SERVICE_IMG
-from BaseDeclarations import ProvidedService, AuthorizedActivity, Legend
+from Company import Company
+from BaseDeclarations import AuthorizedActivity, Legend, ACPR_GRID
 import RegaLog
 
 
-N_INVESTMENT_SERVICES = 45                        # Should get 5 instruments x 9 services
-
-
 class DomesticCompany(Company):
     """
     From my investigations, one can find the following types of domestically regulated/registered companies :
@@ -54,51 +50,26 @@ class DomesticCompany(Company):
         - Changeur manuel (-)
     Not all will be implemented for my needs.
     """
+    __abstract__ = True     # cf. Company
     ACPR_activities = {v: k for k, v in Legend.getACPRActivities().items()}  # need reverse legend here
+    GRID = ACPR_GRID
 
-    def _retrieveInvestmentServices(self, frenchActivitiesDiv, cib):
-        try:
-            services = self._findInvestmentServices(frenchActivitiesDiv, N_INVESTMENT_SERVICES)
-        except (ValueError, ParsingError) as e:
-            RegaLog.logger.error("[CIB: {}]".format(cib) + e)
-            return
-
-        n_instrument = 0
-        n_service = 1
-        for serviceTd in services:
-            # retrieving current service/instrument from position
-            n_instrument += 1
-            if n_instrument > 5:
-                n_instrument = 1
-                n_service += 1
-
-            isServiceProvided = serviceTd.find('img')['src'] == PROVIDED_SERVICE_IMG
-            if isServiceProvided:
-                self.provided_services.add(ProvidedService(cib=int(cib), service=n_service, instrument=n_instrument))
+    def _buildProfile(self):
+        return self.getServicesMask(), self.getActivitiesMask()
 
     def _retrieveAuthorizedActivities(self, frenchActivitiesDiv, number, cib):
         """
             :param number the number of services listed (whether ticked or not) that we must find,
             or 0 to skip check
         """
-        def findActivitiesTables(tag):
-            if tag.name != 'table':
-                return False
-            if tag.has_attr('class') or not tag.has_attr('summary'):
-                return False
-            return tag['summary'] == ''
-
-        activityTrs = []
-        for table in frenchActivitiesDiv.find_all(findActivitiesTables):
-            activityTrs += table.find_all('tr')
-
-        if number and len(activityTrs) != number:
+        activities = self._findAuthorizedActivities(frenchActivitiesDiv)
+
+        if number and len(activities) != number:
             RegaLog.logger.error("[CIB: {}]".format(cib) + "Got unexpected number of authorized services, skipping")
 
-        for activityTr in activityTrs:
-            tds = activityTr.find_all('td')
-            if tds[0].find('img')['src'] == PROVIDED_SERVICE_IMG:
-                self.authorized_activities.append(AuthorizedActivity(cib=cib, activity=DomesticCompany.ACPR_activities.get(tds[1].contents[0].strip())))
+        for isActivityAuthorized, name in activities:
+            if isActivityAuthorized:
+                self.authorized_activities.append(AuthorizedActivity(cib=cib, activity=DomesticCompany.ACPR_activities.get(name)))
 
 
 class CreditInvestmentServicesCompany(DomesticCompany):
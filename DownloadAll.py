@@ -21,80 +21,120 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 from bs4 import BeautifulSoup
-import urllib.request
-import csv
+from concurrent.futures import ThreadPoolExecutor
+from RegaHTTP import HTTPClient, HTTPError
+from CrawlControl import AdaptiveController, TRANSIENT_STATUSES, DEFAULT_MAX_RETRIES
+from RawStore import DirectoryStore, openStore
+from CrawlState import CrawlDBSession, SearchURICache, CrawlJournal, JournalEntry, RefreshState, hashZones
+from WorkList import WorkList, EXPORT_FILE, CIB_COLUMN_NAME, isAgent
+from RegaStats import RunStats
+from datetime import timedelta
+import argparse
+import threading
+import time
 import re
 import sys
 
 
-FIRM_LIST_FILE = 'regafi_export.csv'
-FR_CIB_COLUMN_NAME = 'Code Banque (CIB) ou N° d\'enregistrement'
-SAVE_DIR = 'RawResults'
+FIRM_LIST_FILE = EXPORT_FILE
+FR_CIB_COLUMN_NAME = CIB_COLUMN_NAME
 
 WEBSITE = 'https://www.regafi.fr'
 MAIN_CIB_SEARCH_URI = '/spip.php?page=results&type=advanced&id_secteur=&lang=fr&denomination=&siren=&cib=%s&bic=&nom=&siren_agent=&num=&cat=0&retrait=0'
 MAIN_IN_SEARCH_URI = '/spip.php?page=results&type=advanced&id_secteur=&lang=fr&denomination=&siren=&cib=&bic=&nom=&siren_agent=&num%s=&cat=0&retrait=0'
+LISTING_URI = '/spip.php?page=results&type=advanced&id_secteur=%s&lang=fr&denomination=&siren=&cib=&bic=&nom=&siren_agent=&num=&cat=%s&retrait=0&debut_resultats=%d'
 FR_TABLE_SUMMARY = 'Résultat de votre recherche'
 RESULTS_DIV_CLASSNAME = ['main', 'main_evol']
+CHANGE_DETECTION_DIV_IDS = ['zone_description', 'zone_en_france']
+NOT_MODIFIED = 'Not Modified'
 
 
-def getAllCIBs(firm_list_file):
-    """ Beware: multiple entries for one given CIB behave not very well. The latest (in the list)
-        overwrites the other(s?). I guess (hope...) that information about activities is the same
-        for all entries."""
+class RateLimiter(object):
+    """ Spaces out requests so that no more than `rate` of them are started per second, whatever the number of
+        threads sharing the limiter. A rate of 0 disables the limitation.
+    """
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
 
-    with open(firm_list_file, 'r', newline='', encoding='latin-1') as f:
-        # I am not very happy with this solution because it requires to keep the source file open
-        # during the whole process. However, I doubt creating a cache would be more elegant...
-        csvreader = csv.reader(f, delimiter=';')
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
-        # Find index of CIB field, and incidentally move to the first content line
-        line = next(csvreader)
-        while len(line) == 0:
-            line = next(csvreader)
-        try:
-            index = line.index(FR_CIB_COLUMN_NAME)
-        except:
-            print('An error occurred during the parsing of %s' % firm_list_file, file=sys.stderr)
-            exit(-1)
 
-        # To resume from a specific point
-        while True:
-            try:
-                if next(csvreader)[index].split('"')[1] == '797894888':
-                    break
-            except IndexError: # some exempted have no identifier
-                continue
-
-        # Generate CIBs list
-        try:
-            while True:
-                try:
-                    yield next(csvreader)[index].split('"')[1]          # '=("CIB")' in csv file
-                except IndexError: # some exempted have no identifier
-                    continue
-        except StopIteration:
-            return
+rateLimiter = RateLimiter()
+httpClient = HTTPClient()
+controller = AdaptiveController(maxLimit=1)
+searchURICache = SearchURICache()
+crawlJournal = CrawlJournal()
+refreshState = RefreshState()
+pageStore = DirectoryStore()
+workList = WorkList()
+runStats = RunStats()
+
+
+def fetch(url):
+    def get():
+        return httpClient.get(url)
 
+    return controller.call(get, rateLimiter.wait)
 
-def downloadCIB(cib):
+
+def fetchResponse(url, headers=None):
+    def request():
+        response = httpClient.request(url, headers)
+        if response.status in TRANSIENT_STATUSES:
+            raise HTTPError(url, response.status, response.headers)
+        return response
+
+    return controller.call(request, rateLimiter.wait)
+
+
+def downloadCIB(cib, modifiedSince=None):
     """ A global request on investment firms gives access only to their CIB. To query for their authorizations, we need
         their internal id (or even better, the URI of the request) that can be retrieved through an advanced search
         using the CIB of the firm. Hence the two step process ...
-        :return Search Results DIV tag, or None
+        The URI found is cached across crawls: when it is known, a single request is needed. If the cached URI does
+        not lead to the firm description anymore, it is dropped and the search performed again.
+        :param modifiedSince: If-Modified-Since header value, only used when the URI is cached
+        :return Search Results DIV tag, NOT_MODIFIED, or None
     """
     def findSearchResultsDiv(tag):
         return tag.name == 'div' and tag.has_attr('class') and tag['class'] == RESULTS_DIV_CLASSNAME
 
+    searchURIWithID = searchURICache.get(cib)
+    if searchURIWithID is not None:
+        response = fetchResponse(WEBSITE + searchURIWithID,
+                                 {'If-Modified-Since': modifiedSince} if modifiedSince else None)
+        if response.status == 304:
+            return NOT_MODIFIED
+        searchResultsDiv = None
+        if response.status == 200:
+            with runStats.time('parse'):
+                searchResultsDiv = BeautifulSoup(response.body, "lxml").find(findSearchResultsDiv)
+        if searchResultsDiv is not None:
+            return searchResultsDiv
+        searchURICache.invalidate(cib)
 
     try:
         searchURIWithID = retrieveSearchURIWithID(cib)
-    except:
-        print('Unable to retrieve searchURI for CIB %s' % cib, file=sys.stderr)
+    except Exception as e:
+        print('Unable to retrieve searchURI for CIB %s (%s)' % (cib, e), file=sys.stderr)
         return None
 
-    soup = BeautifulSoup(urllib.request.urlopen(WEBSITE + searchURIWithID).read(), "lxml")
-    return soup.find(findSearchResultsDiv)
+    page = fetch(WEBSITE + searchURIWithID)
+    with runStats.time('parse'):
+        searchResultsDiv = BeautifulSoup(page, "lxml").find(findSearchResultsDiv)
+    if searchResultsDiv is not None:
+        searchURICache.put(cib, searchURIWithID)
+    return searchResultsDiv
 
 
 def retrieveSearchURIWithID(cib):
@@ -108,32 +148,233 @@ def retrieveSearchURIWithID(cib):
     def findSearchURIWithID(tag):
         return tag.name == 'a' and re.match('.*;id=\d+.*$', tag.__str__())
 
-    if int(cib) < 100000: # real CIB
+    if not isAgent(cib): # real CIB
         searchURL = WEBSITE + MAIN_CIB_SEARCH_URI % cib
     else:
         searchURL = WEBSITE + MAIN_IN_SEARCH_URI % cib
 
-    soup = BeautifulSoup(urllib.request.urlopen(searchURL).read(), "lxml")
+    soup = BeautifulSoup(fetch(searchURL), "lxml")
     searchURIWithID = soup.find(findSearchResultsTable).find(findSearchURIWithID)['href']
     return searchURIWithID
 
 
+def harvestListings(sectors=('',), category=0):
+    """ Pages through the result listings of an advanced search without criteria (other than the sector and the
+        category) and records the search URI of every firm listed, keyed by its CIB, in the search URI cache. A full
+        crawl then needs a single request per firm.
+        Parsing strategy: same table as retrieveSearchURIWithID, each row holding a link with an id and a cell with
+        the CIB (or registration number). An empty page, or the same page served again, ends the listing.
+        :return number of firms found
+    """
+    def findSearchResultsTable(tag):
+        return tag.has_attr('summary') and tag['summary'] == FR_TABLE_SUMMARY
+
+    harvested = dict()
+    for sector in sectors:
+        start = 0
+        previous = None
+        while True:
+            print("Harvesting sector '%s' from result %d..." % (sector, start))
+            soup = BeautifulSoup(fetch(WEBSITE + LISTING_URI % (sector, category, start)), "lxml")
+            table = soup.find(findSearchResultsTable)
+            listed = dict()
+            for row in table.find_all('tr') if table is not None else []:
+                link = row.find('a', href=re.compile(r'[;&]id=\d+'))
+                cib = next((td.get_text().strip() for td in row.find_all('td') if td.get_text().strip().isdigit()), None)
+                if link is not None and cib is not None:
+                    listed[cib] = link['href']
+            if not listed or listed == previous:
+                break
+            harvested.update(listed)
+            previous = listed
+            start += len(listed)
+
+    searchURICache.putAll(harvested)
+    return len(harvested)
+
+
+def findZones(searchResultsDiv):
+    """ :return the parts of the page the database is built from, as strings (the whole div if they are missing) """
+    zones = [searchResultsDiv.find('div', id=zone) for zone in CHANGE_DETECTION_DIV_IDS]
+    if all(zone is None for zone in zones):
+        return [str(searchResultsDiv)]
+    return [str(zone) for zone in zones if zone is not None]
+
+
 def processCIB(cib):
-    searchResultsDiv = downloadCIB(cib)
+    """ :return True if the description of the firm has been saved, or is known to be up to date """
+    searchResultsDiv = downloadCIB(cib, refreshState.modifiedSince(cib))
+    if searchResultsDiv is NOT_MODIFIED:
+        runStats.count('not modified')
+        refreshState.recordNotModified(cib)
+        return True
     if searchResultsDiv is None:
         print("Error while processing CIB %s, skipping" % cib, file=sys.stderr)
+        return False
+
+    digest = hashZones(findZones(searchResultsDiv))
+    if refreshState.hasChanged(cib, digest) or cib not in pageStore:
+        with runStats.time('store'):
+            pageStore.put(cib, searchResultsDiv.prettify() if pageStore.PRETTIFY else str(searchResultsDiv))
+    refreshState.recordPage(cib, digest)
+    return True
+
+
+def crawlCIB(cib):
+    #Beware: cib may contain a registering number instead
+    print("Processing CIB %s..." % cib)
+    crawlJournal.markPending(cib)
+    try:
+        saved = processCIB(cib)
+    except Exception as e:
+        print("Error while processing CIB %s (%s), skipping" % (cib, e), file=sys.stderr)
+        saved = False
+    if saved:
+        crawlJournal.markDone(cib)
     else:
-        with open(SAVE_DIR + '/' + cib + '.div', 'w') as f:
-            f.write(searchResultsDiv.prettify())
+        crawlJournal.markFailed(cib)
+    runStats.count('downloaded' if saved else 'failed')
+    runStats.count('pages')
 
 
-def main():
+def crawl(cibs, workers=1):
+    """ Downloads all the given CIBs, either one after the other or through a pool of threads. In the latter case, at
+        most twice as many CIBs as workers are queued at any time so that the CIB generator is consumed lazily.
+    """
+    if workers <= 1:
+        for cib in cibs:
+            crawlCIB(cib)
+        return
+
+    slots = threading.BoundedSemaphore(2 * workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for cib in cibs:
+            slots.acquire()
+            executor.submit(crawlCIB, cib).add_done_callback(lambda future: slots.release())
+
+
+def removeCIB(cib):
+    print("Removing CIB %s..." % cib)
+    pageStore.remove(cib)
+    searchURICache.invalidate(cib)
+    refreshState.recordRemoved(cib)
+
+
+def prepare(args, observer=None, journal=JournalEntry):
+    """ Sets up the crawl shared state (HTTP client, caches, journal, store, stats) from the command line arguments
+        :param observer: see RegaHTTP.HTTPClient
+        :param journal: table of crawl.db the journal is kept in, see CrawlState.CrawlJournal
+    """
+    global rateLimiter, httpClient, controller, searchURICache, crawlJournal, refreshState, pageStore, workList, \
+        runStats
+
+    def observeRequest(*exchange):
+        runStats.observeRequest(*exchange)
+        if observer is not None:
+            observer(*exchange)
+
+    DBSession = CrawlDBSession()
+    runStats = RunStats(getattr(args, 'progress', 0))
+    rateLimiter = RateLimiter(args.rate)
+    httpClient = HTTPClient(connectionsPerHost=args.connections or max(args.workers, 1), observer=observeRequest)
+    controller = AdaptiveController(maxLimit=max(args.workers, 1),
+                                    maxRetries=getattr(args, 'max_retries', DEFAULT_MAX_RETRIES))
+    searchURICache = SearchURICache(DBSession)
+    crawlJournal = CrawlJournal(DBSession, restart=args.restart, entry=journal)
+    maxAge = getattr(args, 'max_age', None)
+    refreshState = RefreshState(DBSession, maxAge=timedelta(days=maxAge) if maxAge is not None else None)
+    pageStore = openStore(archive=args.archive)
+    workList = WorkList.load(FIRM_LIST_FILE, DBSession)
+    shard = getattr(args, 'shard', None)
+    if shard is not None:
+        workList = workList.shard(*shard)
+
+
+def shardArgument(value):
+    """ 'K/N' -> (K - 1, N) """
+    try:
+        index, count = (int(n) for n in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected K/N, e.g. 2/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("expected 1 <= K <= N")
+    return index - 1, count
+
+
+def addCrawlArguments(parser):
+    parser.add_argument('-w', '--workers', type=int, default=1,\
+                        help='Number of concurrent downloads (default: 1, i.e. serial crawl).')
+    parser.add_argument('-r', '--rate', type=float, default=0,\
+                        help='Maximum number of requests per second sent to regafi.fr (default: no limit).')
+    parser.add_argument('-c', '--connections', type=int, default=0,\
+                        help='Maximum number of keep-alive connections to regafi.fr (default: one per worker).')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,\
+                        help='Number of times a request failing with a transient error is retried (default: %d).'
+                             % DEFAULT_MAX_RETRIES)
+    parser.add_argument('--restart', action='store_true',\
+                        help='Forget the progress of the previous crawl and download every firm again.')
+    parser.add_argument('-a', '--archive', action='store_true',\
+                        help='Store pages in the compressed RawResults.archive instead of one file per firm in '
+                             'RawResults.')
+    parser.add_argument('--shard', type=shardArgument,\
+                        help='Only crawl part K of the firms split in N (e.g. 2/4), to share the crawl between '
+                             'several machines, each running in its own directory.')
+    parser.add_argument('--stats', metavar='FILE',\
+                        help='Write the latency of the requests, the time spent in each stage and the throughput of '
+                             'the run to this JSON file.')
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS',\
+                        help='Print a progress line every SECONDS seconds.')
+
+
+def writeStats(args):
+    if getattr(args, 'stats', None):
+        runStats.write(args.stats)
+
+
+def main(args, observer=None):
+    prepare(args, observer)
+
     print("Starting...")
-    for cib in getAllCIBs(FIRM_LIST_FILE):
-        #Beware: cib may contain a registering number instead
-        print("Processing CIB %s..." % cib)
-        processCIB(cib)
+    if args.harvest:
+        print("%d search URIs harvested from the listings" % harvestListings(args.sectors or ('',)))
+    if args.incremental:
+        cibs, removed = refreshState.plan(workList.rowHashItems())
+        print("%d CIBs to download, %d removed from the export" % (len(cibs), len(removed)))
+        for cib in removed:
+            removeCIB(cib)
+    else:
+        cibs = workList
+
+    try:
+        crawl(crawlJournal.remaining(cibs), args.workers)
+    finally:
+        httpClient.close()
+        pageStore.close()
+    failed = crawlJournal.count(CrawlJournal.FAILED)
+    print("Done: %d CIBs downloaded, %d failed (will be retried on next run)"
+          % (crawlJournal.count(CrawlJournal.DONE), failed))
+    if not failed:
+        # the crawl is complete: next run is a new crawl, and the next refresh compares the export against this one
+        refreshState.saveExport(workList.rowHashItems())
+        crawlJournal.clear()
+    writeStats(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=
+                                     'This software downloads the description of every firm listed in the Regafi '
+                                     'export so that regasniff can rebuild the database from it.')
+    addCrawlArguments(parser)
+    parser.add_argument('-i', '--incremental', action='store_true',\
+                        help='Only download firms that are new or whose entry changed in the export since the last '
+                             'complete crawl, and remove the ones that disappeared.')
+    parser.add_argument('--max-age', type=float, default=None,\
+                        help='With --incremental, also check again firms not checked for this many days.')
+    parser.add_argument('--harvest', action='store_true',\
+                        help='Collect the search URIs of all firms from the result listings before crawling, instead '
+                             'of running one search per firm.')
+    parser.add_argument('--sectors', nargs='*',\
+                        help='With --harvest, regafi sector ids to page through (default: all sectors at once).')
+
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import re
+import sys
+import itertools
+import time
+import argparse
+import threading
+from lxml import etree
+from bs4 import BeautifulSoup
+from Company import Company, SoupParser, ParsingError, COMPANY_DIV_ID, FRENCH_ACTIVITIES_DIV_ID, \
+    SERVICES_TABLE_CLASS, SERVICES_TABLE_SUMMARY, PROVIDED_SERVICE_IMG, NOT_PROVIDED_SERVICE_IMG
+from RawStore import openStore
+
+
+# Compiled once, each of them mirrors a predicate of SoupParser (class attributes are compared as a whole, in order,
+# as BeautifulSoup does)
+FIND_DIV = etree.XPath('(//div[@id=$id])[1]')
+FIND_TYPE = etree.XPath('(.//strong[normalize-space(@class)="description"])[1]')
+FIND_FIELDS = etree.XPath('.//li[not(@class)]')
+FIND_SPAN = etree.XPath('(.//span)[1]')
+FIND_SERVICES_TABLE = etree.XPath('(.//table[normalize-space(@class)=$class and @summary=$summary])[1]')
+FIND_HEADINGS = etree.XPath('.//th[@id]')
+TEXT = etree.XPath('string()')
+FIND_ACTIVITIES_TABLES = etree.XPath('.//table[not(@class) and @summary=""]')
+FIND_TRS = etree.XPath('.//tr')
+FIND_TDS = etree.XPath('.//td')
+FIND_IMG_SRC = etree.XPath('(.//img)[1]/@src')
+
+# Start of the divs Company reads, and of every div or end of div, to find where they end
+REGION_START = re.compile(r'<div\b[^>]*(?<![\w-])id\s*=\s*(?:"(%s|%s)"|\'(%s|%s)\'|(%s|%s)(?=[\s/>]))' %
+                          ((re.escape(COMPANY_DIV_ID), re.escape(FRENCH_ACTIVITIES_DIV_ID)) * 3), re.IGNORECASE)
+DIV_TAG = re.compile(r'<(/?)div\b', re.IGNORECASE)
+REGION_START_BYTES = re.compile(REGION_START.pattern.encode('utf-8'), re.IGNORECASE)
+DIV_TAG_BYTES = re.compile(DIV_TAG.pattern.encode('utf-8'), re.IGNORECASE)
+CHECK_CHUNK_SIZE = 1024
+
+_local = threading.local()
+
+
+def parse(page):
+    """ :param page: a saved firm description, str or utf-8 bytes
+        :return the lxml tree of the page, to be given to Company.makeFromMainDiv with XPathParser """
+    if isinstance(page, str):
+        page = page.encode('utf-8')
+    # lxml parsers must not be used by several threads at once
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = etree.HTMLParser(encoding='utf-8')
+    return etree.fromstring(page, parser)
+
+
+def sliceRegions(page):
+    """ Cuts the company description and French activities divs out of page, which is all Company reads, so that the
+        rest of the page is never parsed.
+        :return those divs one after the other, or page itself when no description is found
+    """
+    regions = []
+    end = 0
+    for start in REGION_START.finditer(page):
+        if start.start() < end:
+            continue        # nested in the previous region
+        depth = 0
+        end = len(page)
+        for tag in DIV_TAG.finditer(page, start.start()):
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                end = page.find('>', tag.end()) + 1 or len(page)
+                break
+        regions.append(page[start.start():end])
+    if not regions:
+        return page
+    return ''.join(regions)
+
+
+def streamRegions(chunks):
+    """ Same as sliceRegions, on a page read chunk by chunk: the bytes of the regions are given as soon as they are
+        read, the rest of the page being dropped, so that the page is never held whole in memory.
+        :param chunks: the page as an iterable of utf-8 byte strings, cf. RawStore's chunks
+    """
+    buffer = b''
+    depth = None                # None out of the regions
+    closing = False             # whether the region ends at the next '>'
+    for chunk in itertools.chain(chunks, [None]):
+        last = chunk is None
+        if not last:
+            buffer += chunk
+        while buffer:
+            if closing:
+                end = buffer.find(b'>') + 1
+                if not end:
+                    yield buffer
+                    buffer = b''
+                    break
+                yield buffer[:end]
+                buffer = buffer[end:]
+                closing = False
+                depth = None
+            elif depth is None:
+                start = REGION_START_BYTES.search(buffer)
+                if start is None:
+                    # only keep the tag being read, if any, REGION_START not going past the end of a tag
+                    tag = buffer.find(b'<', buffer.rfind(b'>') + 1)
+                    buffer = buffer[tag:] if tag >= 0 and not last else b''
+                    break
+                buffer = buffer[start.start():]
+                depth = 0
+            else:
+                end = 0
+                for tag in DIV_TAG_BYTES.finditer(buffer):
+                    if tag.end() == len(buffer) and not last:
+                        break           # the next chunk tells whether it is a div
+                    depth += -1 if tag.group(1) else 1
+                    end = tag.end()
+                    if depth == 0:
+                        break
+                if depth == 0:
+                    closing = True
+                elif last:
+                    end = len(buffer)
+                else:
+                    # the end of the buffer may be the start of a div tag
+                    end = max(end, len(buffer) - len(b'</div'))
+                yield buffer[:end]
+                buffer = buffer[end:]
+                if not closing:
+                    break
+
+
+def parseChunks(chunks, restricted=True):
+    """ Parses a page as it is read, for its size not to matter
+        :param chunks: the page as an iterable of utf-8 byte strings, cf. RawStore's chunks
+        :param restricted: only parse the divs Company reads, see streamRegions
+        :return the lxml tree of the page, to be given to Company.makeFromMainDiv with XPathParser
+    """
+    # libxml2 keeps all it is fed until the end of the document: clearing elements as they are parsed would not help
+    parser = etree.HTMLParser(encoding='utf-8')
+    empty = True
+    for chunk in streamRegions(chunks) if restricted else chunks:
+        parser.feed(chunk)
+        empty = False
+    if empty:
+        parser.feed(b'<html></html>')       # nothing Company reads, as for a page without description
+    return parser.close()
+
+
+def makeCompany(page, cib, restricted=True):
+    """ Same as Company.makeFromMainDiv(BeautifulSoup(page, "lxml"), cib), only faster
+        :param restricted: only parse the divs Company reads, see sliceRegions
+    """
+    if restricted:
+        page = sliceRegions(page)
+    return Company.makeFromMainDiv(parse(page), cib, parser=XPathParser)
+
+
+def _first(elements):
+    return elements[0] if elements else None
+
+
+def _text(element):
+    """ Text of the first child of element, as BeautifulSoup's element.contents[0] """
+    if element.text is None:
+        raise TypeError("Unexpected markup in <%s>" % element.tag)
+    return element.text.strip()
+
+
+class XPathParser(object):
+    """ Reads the parts of a firm description Company needs from an lxml tree, with the compiled XPath expressions
+        above instead of walking the tree with Python predicates. Gives the same results as SoupParser.
+    """
+    @staticmethod
+    def findCompanyDiv(mainDiv):
+        return _first(FIND_DIV(mainDiv, id=COMPANY_DIV_ID))
+
+    @staticmethod
+    def readDescription(companyDiv):
+        type = _first(FIND_TYPE(companyDiv))
+        if type is None:
+            return None, []
+
+        fields = []
+        for descriptionLi in FIND_FIELDS(companyDiv):
+            span = _first(FIND_SPAN(descriptionLi))
+            if span is None:
+                raise TypeError("No value for field '%s'" % _text(descriptionLi))
+            fields.append((_text(descriptionLi), _text(span)))
+        return _text(type), fields
+
+    @staticmethod
+    def findFrenchActivitiesDiv(mainDiv):
+        return _first(FIND_DIV(mainDiv, id=FRENCH_ACTIVITIES_DIV_ID))
+
+    @staticmethod
+    def readServicesGrid(frenchActivitiesDiv):
+        servicesTable = _first(FIND_SERVICES_TABLE(frenchActivitiesDiv, summary=SERVICES_TABLE_SUMMARY,
+                                                   **{'class': ' '.join(SERVICES_TABLE_CLASS)}))
+        if servicesTable is None:
+            raise ParsingError("Error while parsing CB services")
+
+        headings = {heading.get('id'): TEXT(heading) for heading in FIND_HEADINGS(servicesTable)}
+        # plain iteration beats an XPath with predicates on the cells, the costliest part of the page
+        cells = []
+        for td in servicesTable.iter('td'):
+            headers = td.get('headers')
+            if headers is None:
+                continue
+            img = td.find('*')
+            if img is None or img.tag != 'img':
+                continue
+            src = img.get('src')
+            if src == PROVIDED_SERVICE_IMG or src == NOT_PROVIDED_SERVICE_IMG:
+                cells.append((src == PROVIDED_SERVICE_IMG, headers))
+        return headings, cells
+
+    @staticmethod
+    def readAuthorizedActivities(frenchActivitiesDiv):
+        activities = []
+        for table in FIND_ACTIVITIES_TABLES(frenchActivitiesDiv):
+            for activityTr in FIND_TRS(table):
+                tds = FIND_TDS(activityTr)
+                activities.append((FIND_IMG_SRC(tds[0])[:1] == [PROVIDED_SERVICE_IMG], tds[1].text.strip()))
+        return activities
+
+
+def describe(company):
+    """ :return everything extracted about company, as plain data, to compare parsers """
+    if company is None:
+        return None
+    return type(company).__name__, company.toRecord()
+
+
+def check(pages):
+    """ Parses every page with BeautifulSoup as regasniff always did, and with each faster way of doing it
+        :return (number of pages, {name of the parser: (seconds, CIBs for which it disagrees with the reference)})
+    """
+    def streamed(page, cib):
+        page = page.encode('utf-8')
+        # small chunks, for the regions to straddle them
+        chunks = (page[n:n + CHECK_CHUNK_SIZE] for n in range(0, len(page), CHECK_CHUNK_SIZE))
+        return Company.makeFromMainDiv(parseChunks(chunks), cib, parser=XPathParser)
+
+    parsers = {
+        'BeautifulSoup': lambda page, cib: Company.makeFromMainDiv(BeautifulSoup(page, "lxml"), cib),
+        'BeautifulSoup restricted': lambda page, cib: Company.makeFromMainDiv(
+            BeautifulSoup(page, "lxml", parse_only=SoupParser.STRAINER), cib),
+        'XPath': lambda page, cib: makeCompany(page, cib, restricted=False),
+        'XPath restricted': makeCompany,
+        'XPath streamed': streamed,
+    }
+    results = {name: [0, []] for name in parsers}
+    count = 0
+    for cib, page in pages:
+        count += 1
+        expected = None
+        for name, parse in parsers.items():
+            start = time.monotonic()
+            got = describe(parse(page, cib))
+            results[name][0] += time.monotonic() - start
+            if name == 'BeautifulSoup':
+                expected = got
+            elif got != expected:
+                results[name][1].append(cib)
+    return count, results
+
+
+def main(args):
+    if args.synthetic:
+        from ReplayServer import makeSyntheticPages
+        pages = makeSyntheticPages(args.synthetic).items()
+        store = None
+    else:
+        store = openStore(archive=args.archive)
+        pages = store
+    try:
+        count, results = check(pages)
+    finally:
+        if store is not None:
+            store.close()
+
+    print("%d pages" % count)
+    failed = False
+    for name, (seconds, mismatches) in results.items():
+        print("%s: %.2fs" % (name, seconds))
+        if mismatches:
+            print("%s disagrees with BeautifulSoup for CIBs %s" % (name, ', '.join(mismatches)), file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+    print("All parsers agree")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+                                     'This software checks that the XPath extractor and the restricted parses give '
+                                     'the same companies as BeautifulSoup on the saved pages, and compares their speed.')
+    parser.add_argument('-a', '--archive', action='store_true',\
+                        help='Read pages from the compressed RawResults.archive instead of RawResults.')
+    parser.add_argument('-s', '--synthetic', type=int, default=0,\
+                        help='Check this number of synthetic firms instead of saved pages.')
+
+    args = parser.parse_args()
+    main(args)
@@ -19,12 +19,8 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 import sys
-from Company import Company, ParsingError, PROVIDED_SERVICE_IMG
-from BaseDeclarations import ProvidedService
-import RegaLog
-
-
-N_INVESTMENT_SERVICES = 150                        # Should get 10 instruments x  15 services
+from Company import Company
+from BaseDeclarations import CB_GRID
 
 
 class PasseportingCompany(Company):
@@ -35,25 +31,9 @@ class PasseportingCompany(Company):
         - Etablissement financier
     Not all will be implemented for my needs.
     """
-    def _retrieveInvestmentServices(self, frenchActivitiesDiv, cib):
-        try:
-            services = self._findInvestmentServices(frenchActivitiesDiv, N_INVESTMENT_SERVICES)
-        except (ValueError, ParsingError) as e:
-            RegaLog.logger.error("[CIB: {}]".format(cib) + e)
-            return
-
-        n_instrument = 1
-        n_service = 0
-        for serviceTd in services:
-            # retrieving current service/instrument from position
-            n_service += 1
-            if n_service > 15:
-                n_service = 1
-                n_instrument += 1
-
-            isServiceProvided = serviceTd.find('img')['src'] == PROVIDED_SERVICE_IMG
-            if isServiceProvided:
-                self.provided_services.add(ProvidedService(cib=int(cib), service=n_service, instrument=n_instrument))
+    __abstract__ = True     # cf. Company
+    GRID = CB_GRID
+
 
 class EUInvestmentServicesCompany(PasseportingCompany):
     # ex 10033
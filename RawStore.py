@@ -0,0 +1,252 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import os
+import threading
+import zlib
+
+
+SAVE_DIR = 'RawResults'
+ARCHIVE_DIR = 'RawResults.archive'
+PAGE_EXTENSION = '.div'
+SEGMENT_NAME = 'segment-%05d.dat'
+INDEX_NAME = 'index'
+SEGMENT_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def openStore(archive=False, readOnly=False):
+    return ArchiveStore(ARCHIVE_DIR, readOnly=readOnly) if archive else DirectoryStore(SAVE_DIR)
+
+
+class DirectoryStore(object):
+    """ The historical layout: one prettified file per CIB """
+    PRETTIFY = True
+
+    def __init__(self, directory=SAVE_DIR):
+        self.directory = directory
+
+    def put(self, cib, page):
+        os.makedirs(self.directory, exist_ok=True)
+        # written aside then renamed, so that an interrupted crawl never leaves a truncated page behind
+        filename = self._filename(cib)
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(page)
+        os.replace(filename + '.tmp', filename)
+
+    def get(self, cib):
+        try:
+            with open(self._filename(cib), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def chunks(self, cib):
+        """ :return the page as an iterator over utf-8 chunks of at most READ_CHUNK_SIZE bytes, None if it is not
+            there, so that it never has to be held whole in memory """
+        try:
+            f = open(self._filename(cib), 'rb')
+        except FileNotFoundError:
+            return None
+        return self._readChunks(f)
+
+    def mtime(self, cib):
+        try:
+            return os.path.getmtime(self._filename(cib))
+        except FileNotFoundError:
+            return None
+
+    def remove(self, cib):
+        try:
+            os.remove(self._filename(cib))
+        except FileNotFoundError:
+            pass
+
+    def cibs(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [filename[:-len(PAGE_EXTENSION)] for filename in os.listdir(self.directory)
+                if filename.endswith(PAGE_EXTENSION)]
+
+    def __contains__(self, cib):
+        return os.path.exists(self._filename(cib))
+
+    def __iter__(self):
+        """ :return (cib, page) for every page stored """
+        for cib in self.cibs():
+            page = self.get(cib)
+            if page is not None:
+                yield cib, page
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _readChunks(f):
+        with f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                yield chunk
+
+    def _filename(self, cib):
+        return os.path.join(self.directory, cib + PAGE_EXTENSION)
+
+
+class ArchiveStore(object):
+    """ Append-only archive: each page is zlib-compressed and appended to the current segment file, a new segment
+        being started once SEGMENT_SIZE is reached. An index file maps every CIB to (segment, offset, length) of its
+        latest version, one line per write, so that a crash can only lose the pages whose index line is missing.
+        Removing a page appends a line with a negative segment. Pages are stored as is, not prettified.
+    """
+    PRETTIFY = False
+
+    def __init__(self, directory=ARCHIVE_DIR, segmentSize=SEGMENT_SIZE, readOnly=False):
+        """ :param readOnly: only read pages, as the processes parsing them do: nothing is opened for writing """
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.lock = threading.Lock()
+        self.readers = dict()
+        self.index = dict()
+        indexPath = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(indexPath):
+            self._loadIndex(indexPath)
+        if readOnly:
+            self.indexFile = self.segmentFile = None
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        self.indexFile = open(indexPath, 'a')
+
+        self.segment = max([location[0] for location in self.index.values()] + [0])
+        self.segmentFile = open(self._segmentPath(self.segment), 'ab')
+
+    def put(self, cib, page):
+        data = zlib.compress(page.encode('utf-8'))
+        with self.lock:
+            if self.segmentFile.tell() > 0 and self.segmentFile.tell() + len(data) > self.segmentSize:
+                self.segmentFile.close()
+                self.segment += 1
+                self.segmentFile = open(self._segmentPath(self.segment), 'ab')
+            offset = self.segmentFile.tell()
+            self.segmentFile.write(data)
+            self.segmentFile.flush()
+            self._appendIndex(cib, (self.segment, offset, len(data)))
+
+    def get(self, cib):
+        location = self.index.get(cib)
+        if location is None:
+            return None
+        return self._read(location)
+
+    def chunks(self, cib):
+        """ :return the page as an iterator over utf-8 chunks, None if it is not there. The page is decompressed as it
+            is read, READ_CHUNK_SIZE bytes at a time. """
+        location = self.index.get(cib)
+        if location is None:
+            return None
+        return self._readChunks(cib, location)
+
+    def mtime(self, cib):
+        """ Modification time of the segment holding the page: it only tells that the page may have changed """
+        location = self.index.get(cib)
+        if location is None:
+            return None
+        return os.path.getmtime(self._segmentPath(location[0]))
+
+    def remove(self, cib):
+        with self.lock:
+            if cib in self.index:
+                self._appendIndex(cib, (-1, 0, 0))
+
+    def cibs(self):
+        return list(self.index)
+
+    def __contains__(self, cib):
+        return cib in self.index
+
+    def __iter__(self):
+        """ :return (cib, page) for every page stored, reading segments sequentially """
+        for cib, location in sorted(self.index.items(), key=lambda item: item[1]):
+            yield cib, self._read(location)
+
+    def close(self):
+        with self.lock:
+            if self.segmentFile is not None:
+                self.segmentFile.close()
+                self.indexFile.close()
+            for fd in self.readers.values():
+                os.close(fd)
+            self.readers = dict()
+
+    def _appendIndex(self, cib, location):
+        self.indexFile.write('%s %d %d %d\n' % ((cib,) + location))
+        self.indexFile.flush()
+        if location[0] < 0:
+            del self.index[cib]
+        else:
+            self.index[cib] = location
+
+    def _loadIndex(self, indexPath):
+        with open(indexPath, 'r') as f:
+            for line in f:
+                try:
+                    cib, segment, offset, length = line.split()
+                    location = (int(segment), int(offset), int(length))
+                except ValueError:      # last line may be truncated after a crash
+                    continue
+                if location[0] < 0:
+                    self.index.pop(cib, None)
+                else:
+                    self.index[cib] = location
+
+    def _read(self, location):
+        segment, offset, length = location
+        return zlib.decompress(os.pread(self._reader(segment), length, offset)).decode('utf-8')
+
+    def _readChunks(self, cib, location):
+        segment, offset, length = location
+        fd = self._reader(segment)
+        decompressor = zlib.decompressobj()
+        end = offset + length
+        while offset < end:
+            data = os.pread(fd, min(READ_CHUNK_SIZE, end - offset), offset)
+            if not data:
+                raise EOFError("Page %s is truncated in %s" % (cib, self._segmentPath(segment)))
+            offset += len(data)
+            while data:
+                chunk = decompressor.decompress(data, READ_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    def _reader(self, segment):
+        fd = self.readers.get(segment)
+        if fd is None:
+            with self.lock:
+                fd = self.readers.get(segment)
+                if fd is None:
+                    fd = os.open(self._segmentPath(segment), os.O_RDONLY)
+                    self.readers[segment] = fd
+        return fd
+
+    def _segmentPath(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME % segment)
@@ -0,0 +1,166 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import gzip
+import time
+import http.client
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit, urljoin
+
+
+DEFAULT_CONNECTIONS_PER_HOST = 4
+DEFAULT_TIMEOUT = 30
+MAX_REDIRECTS = 5
+USER_AGENT = 'RegaFinder'
+
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status, headers=None):
+        super().__init__("HTTP error %d while fetching %s" % (status, url))
+        self.url = url
+        self.status = status
+        self.headers = headers or dict()
+
+
+class ConnectionPool(object):
+    """ Keep-alive connections to a single host. At most `size` connections are open at the same time, threads asking
+        for more wait until one is given back.
+    """
+    def __init__(self, scheme, netloc, size, timeout):
+        self.connectionClass = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ :return (connection, reused) """
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connectionClass(self.netloc, timeout=self.timeout), False
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class HTTPClient(object):
+    """ Thread-safe HTTP client sharing keep-alive connections between requests, with one pool per host. Bodies are
+        requested gzipped and transparently decompressed.
+        If given, `observer(url, status, seconds, reconnections)` is called after every exchange with the server (a
+        status of None meaning the request failed), e.g. to measure the crawl.
+    """
+    def __init__(self, connectionsPerHost=DEFAULT_CONNECTIONS_PER_HOST, timeout=DEFAULT_TIMEOUT, observer=None):
+        self.connectionsPerHost = connectionsPerHost
+        self.timeout = timeout
+        self.observer = observer
+        self.pools = dict()
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        """ :return the (decompressed) body of the page, following redirections
+            :raise HTTPError if the server does not answer with 200
+        """
+        response = self.request(url, headers)
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.headers)
+        return response.body
+
+    def request(self, url, headers=None):
+        """ GET `url` and return the final Response, whatever its status (conditional requests may expect a 304) """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers)
+            if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+                url = urljoin(url, response.headers['location'])
+                continue
+            return response
+        raise HTTPError(url, response.status)
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+
+    def _notify(self, url, status, start, reconnections):
+        if self.observer is not None:
+            self.observer(url, status, time.monotonic() - start, reconnections)
+
+    def _pool(self, scheme, netloc):
+        with self.lock:
+            pool = self.pools.get((scheme, netloc))
+            if pool is None:
+                pool = ConnectionPool(scheme, netloc, self.connectionsPerHost, self.timeout)
+                self.pools[(scheme, netloc)] = pool
+            return pool
+
+    def _request(self, url, headers):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        requestHeaders = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive', 'User-Agent': USER_AGENT}
+        if headers:
+            requestHeaders.update(headers)
+
+        pool = self._pool(parts.scheme, parts.netloc)
+        start = time.monotonic()
+        reconnections = 0
+        while True:
+            connection, reused = pool.acquire()
+            try:
+                connection.request('GET', path, headers=requestHeaders)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                pool.release(connection, reusable=False)
+                if reused:
+                    # the server closed an idle keep-alive connection, try again with a fresh one
+                    reconnections += 1
+                    continue
+                self._notify(url, None, start, reconnections)
+                raise
+            except BaseException:
+                pool.release(connection, reusable=False)
+                self._notify(url, None, start, reconnections)
+                raise
+            pool.release(connection, reusable=not response.will_close)
+            break
+        self._notify(url, response.status, start, reconnections)
+
+        responseHeaders = {k.lower(): v for k, v in response.getheaders()}
+        if responseHeaders.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return Response(response.status, responseHeaders, body)
@@ -0,0 +1,142 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import sys
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+
+BUCKET_BOUNDS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram(object):
+    """ Durations counted in buckets of increasing width, BUCKET_BOUNDS_MS being their upper bounds """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, p):
+        """ :return the upper bound of the bucket holding the p-th percentile, in milliseconds """
+        if not self.count:
+            return 0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return round(self.max * 1000, 3)
+
+    def report(self):
+        buckets = {'<=%gms' % bound: count for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets) if count}
+        if self.buckets[-1]:
+            buckets['>%gms' % BUCKET_BOUNDS_MS[-1]] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 3),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0,
+            'min_ms': round((self.min or 0) * 1000, 3),
+            'max_ms': round((self.max or 0) * 1000, 3),
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets,
+        }
+
+
+class RunStats(object):
+    """ Stage timers and counters of a run, thread-safe. The 'pages' counter gives the throughput of the run; if
+        progressInterval is set, a progress line is printed on stderr every progressInterval seconds as it grows.
+    """
+    def __init__(self, progressInterval=0):
+        self.progressInterval = progressInterval
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.counters = dict()
+        self.started = time.monotonic()
+        self.lastProgress = self.started
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+        if counter == 'pages' and self.progressInterval:
+            self._progress()
+
+    def observeRequest(self, url, status, seconds, reconnections):
+        """ RegaHTTP.HTTPClient observer: times every request as the 'fetch' stage """
+        self.record('fetch', seconds)
+        self.count('status %s' % status)
+        if reconnections:
+            self.count('reconnections', reconnections)
+
+    def report(self):
+        seconds = time.monotonic() - self.started
+        with self.lock:
+            pages = self.counters.get('pages', 0)
+            return {
+                'seconds': round(seconds, 3),
+                'pages': pages,
+                'pages_per_second': round(pages / seconds, 2) if seconds else 0,
+                'counters': dict(sorted(self.counters.items())),
+                'stages': {stage: histogram.report() for stage, histogram in self.stages.items()},
+            }
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def _progress(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.lastProgress < self.progressInterval:
+                return
+            self.lastProgress = now
+            pages = self.counters.get('pages', 0)
+            stages = ', '.join('%s %.1fms' % (stage, histogram.total / histogram.count * 1000)
+                               for stage, histogram in self.stages.items() if histogram.count)
+        print("[%.0fs] %d pages, %.1f pages/s (mean %s)" % (now - self.started, pages, pages / (now - self.started),
+                                                            stages), file=sys.stderr)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import re
+import gzip
+import time
+import random
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from BaseDeclarations import Legend
+from RawStore import openStore
+
+
+SEARCH_PAGE = '<html><body><table summary="Résultat de votre recherche">' \
+              '<tr><th>Dénomination</th><th>CIB</th></tr>%s</table></body></html>'
+SEARCH_ROW = '<tr><td><a href="/spip.php?page=results&amp;type=advanced&amp;lang=fr&amp;id=%d">%s</a></td>' \
+             '<td>%s</td></tr>'
+DETAIL_PAGE = '<html><body>%s</body></html>'
+LISTING_PAGE_SIZE = 20
+PROVIDED_SERVICE_IMG = 'squelettes/img/checked.png'
+NOT_PROVIDED_SERVICE_IMG = 'squelettes/img/unchecked.png'
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """ Stand-in for regafi.fr, answering the advanced searches and serving the firm descriptions it has been given,
+        so that the crawler can be measured and tested offline. Each answer is delayed by `latency` seconds (plus or
+        minus `jitter`), and a proportion `errorRate` of the requests fail with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, pages, latency=0, jitter=0, errorRate=0, seed=None):
+        """ :param pages: dict CIB -> search results div of the firm, as a string """
+        super().__init__(address, ReplayHandler)
+        self.pages = pages
+        self.ids = {cib: n for n, cib in enumerate(sorted(pages), 1)}
+        self.cibs = {n: cib for cib, n in self.ids.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.served = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def draw(self):
+        """ :return (delay, fail) for the next request """
+        with self.lock:
+            self.served += 1
+            delay = max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.errorRate
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def serveInBackground(self):
+        thread = threading.Thread(target=self.serve_forever, name='replay-server', daemon=True)
+        thread.start()
+        return thread
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        delay, fail = self.server.draw()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            self._send(503, b'Service Unavailable')
+            return
+
+        query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+        if 'id' in query:
+            self._sendDetail(query)
+        else:
+            self._sendSearch(query)
+
+    def _sendDetail(self, query):
+        cib = self.server.cibs.get(int(query['id'][0]))
+        if cib is None:
+            self._send(404, b'Not Found')
+            return
+        modifiedSince = self.headers.get('If-Modified-Since')
+        if modifiedSince is not None and parsedate_to_datetime(modifiedSince).timestamp() >= int(self.server.started):
+            self._send(304, b'')
+            return
+        self._send(200, (DETAIL_PAGE % self.server.pages[cib]).encode('utf-8'))
+
+    def _sendSearch(self, query):
+        # registration numbers are looked for with 'num<number>=', cf. DownloadAll.MAIN_IN_SEARCH_URI
+        cib = (query.get('cib') or [''])[0]
+        if not cib:
+            cib = next((key[3:] for key in query if re.match(r'num\d+$', key)), '')
+        if cib:
+            cibs = [cib] if cib in self.server.ids else []
+        else:
+            # no criteria: paginated listing of every firm, cf. DownloadAll.LISTING_URI
+            start = int((query.get('debut_resultats') or ['0'])[0] or 0)
+            cibs = sorted(self.server.ids)[start:start + LISTING_PAGE_SIZE]
+        rows = ''.join(SEARCH_ROW % (self.server.ids[cib], cib, cib) for cib in cibs)
+        self._send(200, (SEARCH_PAGE % rows).encode('utf-8'))
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Last-Modified', formatdate(self.server.started, usegmt=True))
+        if status == 200 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def loadPages(archive=False):
+    store = openStore(archive=archive)
+    pages = dict(store)
+    store.close()
+    return pages
+
+
+def makeSyntheticPages(count, seed=0):
+    """ Builds `count` plausible firm descriptions, one third of them passported (150-cell grid), the others domestic
+        investment firms (45-cell grid plus authorized activities).
+        :return dict CIB -> search results div
+    """
+    rng = random.Random(seed)
+    pages = dict()
+    for n in range(count):
+        cib = '%05d' % (10000 + n)
+        pages[cib] = makeSyntheticPage(cib, passported=(n % 3 == 0), rng=rng)
+    return pages
+
+
+def makeSyntheticPage(cib, passported, rng):
+    def img(ratio):
+        return PROVIDED_SERVICE_IMG if rng.random() < ratio else NOT_PROVIDED_SERVICE_IMG
+
+    def grid(rows, columns):
+        html = ['<table class="petite-police services-invest" summary="Services d\'investissement"><tr><th></th>']
+        html += ['<th id="c%d">%s</th>' % (column, name) for column, name in sorted(columns.items())]
+        html.append('</tr>')
+        for row, name in sorted(rows.items()):
+            html.append('<tr><th id="r%d">%s</th>' % (row, name))
+            html += ['<td headers="r%d c%d"><img src="%s" alt=""/></td>' % (row, column, img(0.4))
+                     for column in sorted(columns)]
+            html.append('</tr>')
+        html.append('</table>')
+        return ''.join(html)
+
+    authType = 'Passeport européen en entrée' if passported else 'Agrément ACPR'
+    html = ['<div class="main main_evol"><div id="zone_description">',
+            '<strong class="description">Entreprise d\'investissement</strong><ul>',
+            '<li>Code banque (CIB) : <span>%s</span></li>' % cib,
+            '<li>Dénomination sociale : <span>SYNTHETIC FIRM %s</span></li>' % cib,
+            '<li>SIREN : <span>%09d</span></li>' % rng.randrange(10 ** 9),
+            '<li>Nature d\'autorisation : <span>%s</span></li>' % authType,
+            '<li>Ville : <span>Paris</span></li>',
+            '</ul></div><div id="zone_en_france">']
+    if passported:
+        html.append(grid(Legend.getCBInstruments(), Legend.getCBServices()))
+    else:
+        html.append('<table summary="">')
+        for activity in (2, 3):
+            html.append('<tr><td><img src="%s"/></td><td>%s</td></tr>' % (img(0.5), Legend.getACPRActivities()[activity]))
+        html.append('</table>')
+        html.append(grid(Legend.getACPRServices(), Legend.getACPRInstruments()))
+    html.append('</div></div>')
+    return '\n'.join(html)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+                                     'This software serves the pages saved by DownloadAll (or synthetic ones) the way '
+                                     'regafi.fr does, to test the crawler offline.')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-a', '--archive', action='store_true',\
+                        help='Serve pages from RawResults.archive instead of RawResults.')
+    parser.add_argument('-s', '--synthetic', type=int, default=0,\
+                        help='Serve this number of synthetic firms instead of saved pages.')
+    parser.add_argument('--latency', type=float, default=0, help='Delay of each answer, in seconds.')
+    parser.add_argument('--jitter', type=float, default=0, help='Random variation of the delay, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Proportion of requests answered with a 503.')
+
+    args = parser.parse_args()
+    pages = makeSyntheticPages(args.synthetic) if args.synthetic else loadPages(args.archive)
+    server = ReplayServer(('127.0.0.1', args.port), pages, args.latency, args.jitter, args.error_rate)
+    print("Serving %d firms on %s" % (len(pages), server.url))
+    server.serve_forever()
@@ -18,11 +18,19 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 """
 
 
+import json
+import heapq
+import tempfile
+import itertools
+import numpy
 from sortedcontainers import SortedListWithKey
-from BaseDeclarations import AuthorizedActivity, ProvidedService
+from BaseDeclarations import AuthorizedActivity, ProvidedService, CompanyDescription, RegafiDBSession
 from BaseDeclarations import Legend
-from BaseDeclarations import ServiceList
-from DomesticCompany import DomesticCompany
+from BaseDeclarations import ACPR_GRID, activityBit
+
+
+STREAM_CHUNK_SIZE = 1000           # companies scored at once by processStream
+RANKING_RUN_SIZE = 50000           # companies sorted in memory before being written aside, cf. Ranking
 
 
 # Should be in screener, and built dynamically from a configuration file
@@ -39,43 +47,141 @@ SERVICE_RULES = {
 }
 
 
-CB_TO_ACPR_INSTRUMENTS_MATCHER = {
-    1: [1, 2],
-    2: [5],
-    3: [3],
-    4: [4],
-    5: [2, 9],
-    6: [4],
-    7: [4],
-    8: [4],
-    9: [5],
-    10: [4]
-}
-
-CB_SERVICES_TO_ACPR_SERVICES_MATCHER = {
-    1: [1],
-    2: [2],
-    3: [3],
-    4: [4],
-    5: [5],
-    6: [6, 7],
-    7: [8],
-    8: [9]
-}
+class ScoreMatrix(object):
+    """ Companies as the rows of a 0-1 matrix, whose columns are the cells of the ACPR grid (in the order of the bits of
+        their masks) then the ACPR activities, read from their profile (cf. Company.getProfile). Scoring them all is a
+        single product of this matrix with the weights of the rules, over the same columns.
+    """
+    N_ACTIVITIES = len(Legend.getACPRActivities())
+    N_FEATURES = ACPR_GRID.size + N_ACTIVITIES
 
-CB_SERVICES_TO_ACPR_ACTIVITIES_MATCHER = {
-    9: [3]
-}
+    def __init__(self, companies):
+        services = []
+        activities = []
+        for company in companies:
+            servicesMask, activitiesMask = company.getProfile()
+            services.append(servicesMask)
+            activities.append(activitiesMask)
+        self.features = numpy.hstack([self._unpack(services, ACPR_GRID.size),
+                                      self._unpack(activities, self.N_ACTIVITIES)])
+
+    @classmethod
+    def weights(cls, serviceRules, activityRules):
+        """ :param serviceRules: weight of each ProvidedService over the ACPR grid, likewise activityRules
+            :return the weights of the columns of the matrix
+        """
+        weights = numpy.zeros(cls.N_FEATURES, dtype=numpy.int64)
+        for service, weight in serviceRules.items():
+            weights[ACPR_GRID.bit(service.service, service.instrument).bit_length() - 1] += weight
+        for activity, weight in activityRules.items():
+            weights[ACPR_GRID.size + activity.activity - 1] += weight
+        return weights
+
+    def score(self, weights):
+        """ :param weights: as given by ScoreMatrix.weights, or one set of them per column to try several sets of rules
+            at once
+            :return the scores of the companies, in their order, one column per set of rules if there are several
+        """
+        return self.features @ weights
+
+    @staticmethod
+    def _unpack(masks, width):
+        """ :return one row of width 0-1 columns per mask, bit n of the mask in column n """
+        size = (width + 7) // 8
+        data = b''.join((mask & ((1 << width) - 1)).to_bytes(size, 'little') for mask in masks)
+        bits = numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(masks), size)
+        return numpy.unpackbits(bits, axis=1, count=width, bitorder='little')
+
+
+class Ranking(object):
+    """ All the companies scored, best first, through an external sort: companies are described as they are added,
+        sorted RANKING_RUN_SIZE at a time into temporary files, which are then merged """
+    def __init__(self):
+        self.entries = []
+        self.runs = []
+
+    def add(self, company):
+        self.entries.append((-company.score, -company.cib, str(company)))
+        if len(self.entries) >= RANKING_RUN_SIZE:
+            self._spill()
+
+    def write(self, file):
+        self._spill()
+        for run in self.runs:
+            run.seek(0)
+        # one line per company in the runs, its description being encoded as JSON
+        entries = heapq.merge(*[map(json.loads, run) for run in self.runs])
+        with open(file, 'w') as f:
+            for score, cib, description in entries:
+                f.write(description + '\n\n\n')
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+    def _spill(self):
+        if not self.entries:
+            return
+        run = tempfile.TemporaryFile('w+')
+        for entry in sorted(self.entries):
+            run.write(json.dumps(entry) + '\n')
+        self.runs.append(run)
+        self.entries = []
 
 
 class Screener(object):
     def __init__(self):
         self.l = SortedListWithKey(key=lambda company: company.score)
+        self.weights = ScoreMatrix.weights(SERVICE_RULES, ACTIVITY_RULES)
+        # the same rules, for SQLite, cf. BaseDeclarations.SCREENING_RULES
+        self.rules = [{'services_bit': ACPR_GRID.bit(service.service, service.instrument), 'activities_bit': 0,
+                       'weight': weight} for service, weight in SERVICE_RULES.items()]
+        self.rules += [{'services_bit': 0, 'activities_bit': activityBit(activity.activity), 'weight': weight}
+                       for activity, weight in ACTIVITY_RULES.items()]
 
     def process(self, companies):
-        for company in companies:
-            print("Processing %d..." % company.cib)
-            self._computeScore(company)
+        companies = list(companies)
+        print("Processing %d companies..." % len(companies))
+        for company, score in zip(companies, ScoreMatrix(companies).score(self.weights)):
+            company.score = int(score)
+            self.l.add(company)
+
+    def processTop(self, session, n):
+        """ Same as process on the n best companies of the database only, scored by SQLite: the others are never
+            loaded """
+        scores = dict(RegafiDBSession.topScores(session.connection(), self.rules, n))
+        print("Processing the %d best companies..." % len(scores))
+        companies = RegafiDBSession.queryCompanies(session).filter(CompanyDescription.cib.in_(scores))
+        # in the order process gets them, for ties to be printed in the same order
+        for company in sorted(companies, key=lambda company: company.cib):
+            company.score = scores[company.cib]
+            self.l.add(company)
+
+    def processStream(self, companies, k, rankingFile=None):
+        """ Same as process for the k best companies only, companies being scored STREAM_CHUNK_SIZE at a time and only
+            the k best of them kept, whatever their number
+            :param companies: e.g. a query with yield_per, for companies to be loaded as they are scored
+            :param rankingFile: where to write all the companies, best first, as print does
+        """
+        best = []           # heap of (score, cib, company), the worst of the k best first
+        ranking = Ranking() if rankingFile else None
+        count = 0
+        companies = iter(companies)
+        for chunk in iter(lambda: list(itertools.islice(companies, STREAM_CHUNK_SIZE)), []):
+            count += len(chunk)
+            for company, score in zip(chunk, ScoreMatrix(chunk).score(self.weights)):
+                company.score = int(score)
+                # ties broken by CIB, as print does
+                if len(best) < k:
+                    heapq.heappush(best, (company.score, company.cib, company))
+                elif (company.score, company.cib) > best[0][:2]:
+                    heapq.heapreplace(best, (company.score, company.cib, company))
+                if ranking is not None:
+                    ranking.add(company)
+            print("Processed %d companies..." % count)
+        if ranking is not None:
+            ranking.write(rankingFile)
+        # in the order process gets them, for ties to be printed in the same order
+        for score, cib, company in sorted(best, key=lambda entry: entry[1]):
             self.l.add(company)
 
     def print(self, file):
@@ -101,33 +207,3 @@ class Screener(object):
     # def _parseService(self, service_and_instrument, weight):
     #     service, instrument = service_and_instrument.popitem()
     #     self.services.update({ProvidedService(service=service, instrument=instrument): weight})
-
-    def _computeScore(self, company):
-        score = 0
-        services = company.getServices()
-        activities = company.getActivities()
-        if not isinstance(company, DomesticCompany):
-            domesticazedServices = ServiceList()
-            domesticazedActivities = []
-            for service in services:
-                try:
-                    for domesticazedService in CB_SERVICES_TO_ACPR_SERVICES_MATCHER[service.service]:
-                        for domesticazedInstrument in CB_TO_ACPR_INSTRUMENTS_MATCHER[service.instrument]:
-                            domesticazedServices.add(ProvidedService(service=domesticazedService, instrument=domesticazedInstrument))
-                except KeyError: # maybe  service -> activity
-                    try:
-                        domesticazedActivities.append(AuthorizedActivity(activity=CB_SERVICES_TO_ACPR_ACTIVITIES_MATCHER[service.service]))
-                    except KeyError:
-                        pass
-            services = domesticazedServices
-            activities = domesticazedActivities
-
-        for service, weight in SERVICE_RULES.items():
-            if service in services:
-                score += weight
-        for activity, weight in ACTIVITY_RULES.items():
-            if activity in activities:
-                score += weight
-        company.score = score
-
-
@@ -0,0 +1,167 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import os
+import csv
+import sys
+import zlib
+from array import array
+from CrawlState import WorkItem, WorkListSource, hashRow
+
+
+EXPORT_FILE = 'regafi_export.csv'
+EXPORT_ENCODING = 'latin-1'
+CIB_COLUMN_NAME = 'Code Banque (CIB) ou N° d\'enregistrement'
+SECTOR_COLUMN_NAME = 'Catégorie'       # optional, left empty if the export has no such column
+AGENT_THRESHOLD = 100000                # real CIBs are below, registration numbers of agents above
+
+
+def isAgent(cib):
+    return int(cib) >= AGENT_THRESHOLD
+
+
+def parseCIB(cell):
+    """ '=("CIB")' in csv file
+        :return the CIB, or None (some exempted have no identifier)
+    """
+    parts = cell.split('"')
+    return parts[1] if len(parts) > 2 and parts[1] else None
+
+
+class WorkList(object):
+    """ The firms of the export, deduplicated, as columns: CIB, digest of the line (for incremental diffing), agent flag
+        and sector (stored once in `sectorNames`, each firm holding an index). When a CIB is listed several times, it
+        keeps its first position and the latest line wins.
+        The work list is built once per export and saved in crawl.db, the crawl then never reads the CSV again.
+    """
+    def __init__(self):
+        self.cibs = []
+        self.rowHashes = []
+        self.agents = bytearray()
+        self.sectors = array('H')
+        self.sectorNames = []
+        self.positions = dict()     # cib -> index in the columns
+        self._sectorIndexes = dict()
+
+    def __len__(self):
+        return len(self.cibs)
+
+    def __iter__(self):
+        return iter(self.cibs)
+
+    def __contains__(self, cib):
+        return cib in self.positions
+
+    def add(self, cib, rowHash, agent, sector):
+        sectorIndex = self._sectorIndexes.get(sector)
+        if sectorIndex is None:
+            sectorIndex = self._sectorIndexes[sector] = len(self.sectorNames)
+            self.sectorNames.append(sector)
+        position = self.positions.get(cib)
+        if position is None:
+            self.positions[cib] = len(self.cibs)
+            self.cibs.append(cib)
+            self.rowHashes.append(rowHash)
+            self.agents.append(agent)
+            self.sectors.append(sectorIndex)
+        else:
+            self.rowHashes[position] = rowHash
+            self.agents[position] = agent
+            self.sectors[position] = sectorIndex
+
+    def isAgent(self, cib):
+        return bool(self.agents[self.positions[cib]])
+
+    def sector(self, cib):
+        return self.sectorNames[self.sectors[self.positions[cib]]]
+
+    def rowHashItems(self):
+        """ :return iterator of (cib, digest of its line in the export) """
+        return zip(self.cibs, self.rowHashes)
+
+    def realCIBs(self):
+        return (cib for cib, agent in zip(self.cibs, self.agents) if not agent)
+
+    def shard(self, index, count):
+        """ :return the part `index` (0-based) of the work list split in `count`. A firm always falls in the same
+            shard, whatever the other lines of the export, so a shard can be refreshed on its own.
+        """
+        part = WorkList()
+        for position, cib in enumerate(self.cibs):
+            if zlib.crc32(cib.encode('ascii')) % count == index:
+                part.add(cib, self.rowHashes[position], self.agents[position],
+                         self.sectorNames[self.sectors[position]])
+        return part
+
+    @staticmethod
+    def ingest(exportFile=EXPORT_FILE):
+        """ Reads the export in one pass """
+        workList = WorkList()
+        with open(exportFile, 'r', newline='', encoding=EXPORT_ENCODING) as f:
+            csvreader = csv.reader(f, delimiter=';')
+
+            # Find index of CIB field, and incidentally move to the first content line
+            header = next((line for line in csvreader if line), [])
+            try:
+                cibIndex = header.index(CIB_COLUMN_NAME)
+            except ValueError:
+                print('An error occurred during the parsing of %s' % exportFile, file=sys.stderr)
+                exit(-1)
+            sectorIndex = header.index(SECTOR_COLUMN_NAME) if SECTOR_COLUMN_NAME in header else None
+
+            for line in csvreader:
+                cib = parseCIB(line[cibIndex]) if len(line) > cibIndex else None
+                if cib is None:
+                    continue
+                sector = line[sectorIndex].strip() if sectorIndex is not None and len(line) > sectorIndex else ''
+                workList.add(cib, hashRow(line), isAgent(cib), sector)
+        return workList
+
+    @staticmethod
+    def load(exportFile=EXPORT_FILE, DBSession=None):
+        """ :return the work list saved in crawl.db if it was built from this very export (or if there is no export
+            any more), otherwise ingests the export and saves the result
+        """
+        if DBSession is None:
+            return WorkList.ingest(exportFile)
+
+        session = DBSession()
+        source = session.query(WorkListSource).first()
+        stat = os.stat(exportFile) if os.path.exists(exportFile) else None
+        if source is not None and (stat is None or (source.path == os.path.abspath(exportFile)
+                                                    and source.size == stat.st_size and source.mtime == stat.st_mtime)):
+            workList = WorkList()
+            for item in session.query(WorkItem).order_by(WorkItem.position):
+                workList.add(item.cib, item.row_hash, item.agent, item.sector)
+            session.close()
+            return workList
+
+        workList = WorkList.ingest(exportFile)
+        session.query(WorkItem).delete()
+        session.query(WorkListSource).delete()
+        session.bulk_insert_mappings(WorkItem, [{'position': position, 'cib': cib, 'row_hash': rowHash,
+                                                 'agent': bool(agent), 'sector': workList.sectorNames[sector]}
+                                                for position, (cib, rowHash, agent, sector) in
+                                                enumerate(zip(workList.cibs, workList.rowHashes, workList.agents,
+                                                              workList.sectors))])
+        session.add(WorkListSource(path=os.path.abspath(exportFile), size=stat.st_size, mtime=stat.st_mtime))
+        session.commit()
+        session.close()
+        return workList
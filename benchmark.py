@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import os
+import io
+import csv
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import DownloadAll
+from CrawlState import CrawlJournal
+from ReplayServer import ReplayServer, loadPages, makeSyntheticPages
+
+
+class CrawlRecorder(object):
+    """ HTTPClient observer keeping track of every exchange with the server """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = dict()
+        self.reconnections = 0
+
+    def __call__(self, url, status, seconds, reconnections):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.reconnections += reconnections
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def writeExport(filename, cibs):
+    """ Writes a minimal regafi_export.csv listing the given CIBs """
+    with open(filename, 'w', newline='', encoding='latin-1') as f:
+        csvwriter = csv.writer(f, delimiter=';')
+        csvwriter.writerow(['Dénomination', DownloadAll.FR_CIB_COLUMN_NAME])
+        for cib in cibs:
+            csvwriter.writerow(['FIRM %s' % cib, '=("%s")' % cib])
+
+
+def runCrawl(server, args):
+    """ Crawls `server` from a scratch directory with DownloadAll
+        :return (seconds, recorder, journal, controller)
+    """
+    crawlArgs = argparse.Namespace(workers=args.workers, rate=args.rate, connections=0, restart=True,
+                                   archive=args.archive, incremental=False, max_age=None, max_retries=args.max_retries,
+                                   harvest=args.harvest, sectors=None)
+    recorder = CrawlRecorder()
+    DownloadAll.WEBSITE = server.url
+    workdir = tempfile.mkdtemp(prefix='regabench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        writeExport(DownloadAll.FIRM_LIST_FILE, sorted(server.pages))
+        output = sys.stdout if args.verbose else io.StringIO()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(output):
+            DownloadAll.main(crawlArgs, observer=recorder)
+        seconds = time.monotonic() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return seconds, recorder, DownloadAll.crawlJournal, DownloadAll.controller
+
+
+def main(args):
+    pages = makeSyntheticPages(args.synthetic) if args.synthetic else loadPages(args.from_archive)
+    server = ReplayServer(('127.0.0.1', 0), pages, args.latency, args.jitter, args.error_rate, seed=0)
+    server.serveInBackground()
+    try:
+        seconds, recorder, journal, controller = runCrawl(server, args)
+    finally:
+        server.shutdown()
+
+    failed = journal.count(CrawlJournal.FAILED)
+    done = len(pages) - failed
+    report = {
+        'firms': len(pages),
+        'downloaded': done,
+        'failed': failed,
+        'seconds': round(seconds, 3),
+        'pages_per_second': round(done / seconds, 2) if seconds else 0,
+        'requests': len(recorder.latencies),
+        'latency_p50_ms': round(percentile(recorder.latencies, 50) * 1000, 2),
+        'latency_p99_ms': round(percentile(recorder.latencies, 99) * 1000, 2),
+        'server_errors': server.errors,
+        'retries': controller.retries,
+        'breaker_trips': controller.trips,
+        'final_concurrency': int(controller.limit),
+        'reconnections': recorder.reconnections,
+        'statuses': {str(status): count for status, count in recorder.statuses.items()},
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+                                     'This software measures the crawler throughput offline, running DownloadAll '
+                                     'against a local stand-in for regafi.fr (see ReplayServer).')
+    parser.add_argument('-s', '--synthetic', type=int, default=500,\
+                        help='Number of synthetic firms to serve (default: 500), 0 to serve RawResults.')
+    parser.add_argument('--from-archive', action='store_true',\
+                        help='With --synthetic 0, serve RawResults.archive instead of RawResults.')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='Number of concurrent downloads.')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='Maximum number of requests per second.')
+    parser.add_argument('-a', '--archive', action='store_true', help='Crawl into an archive instead of files.')
+    parser.add_argument('--harvest', action='store_true', help='Harvest the listings before crawling.')
+    parser.add_argument('--max-retries', type=int, default=DownloadAll.DEFAULT_MAX_RETRIES,\
+                        help='Number of retries of transient errors.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Server delay, in seconds (default: 0.02).')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Random variation of the delay, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Proportion of requests failing with a 503.')
+    parser.add_argument('-o', '--output', help='Also write the JSON report to this file.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the crawler output.')
+
+    args = parser.parse_args()
+    main(args)
@@ -21,25 +21,52 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 
 
 import os
+import sys
+import argparse
 from bs4 import BeautifulSoup
 from BaseDeclarations import RegafiDBSession, CompanyDescription, AuthorizedActivity, ProvidedService, \
     ACPR_authorized_activity, ACPR_service, ACPR_service, CB_service, CB_instrument
 from Company import Company
 from DomesticCompany import *
 from PasseportingCompany import *
-from Screener import Screener
+from Screener import Screener, STREAM_CHUNK_SIZE
 
 
-def main():
+def main(args):
     DBSession = RegafiDBSession()
 
     session = DBSession()
-    companies = session.query(CompanyDescription).all()
     screener = Screener()
-    screener.process(companies)
+    if args.stream or args.ranking:
+        companies = RegafiDBSession.queryCompanies(session).yield_per(STREAM_CHUNK_SIZE)
+        screener.processStream(companies, args.top, args.ranking)
+    elif args.top:
+        try:
+            screener.processTop(session, args.top)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        companies = RegafiDBSession.queryCompanies(session).all()
+        screener.process(companies)
     screener.print('screened.txt')
     session.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=
+                                     'This software scores the companies of the Regafi database against the rules of '
+                                     'the screener and writes them, best first, to screened.txt.')
+    parser.add_argument('-n', '--top', type=int, default=0, metavar='N',\
+                        help='Only write the N best companies, scored inside the database without loading the others.')
+    parser.add_argument('-s', '--stream', action='store_true',\
+                        help='Score companies chunk by chunk, only keeping the N best of them in memory, instead of '
+                             'scoring inside the database.')
+    parser.add_argument('-r', '--ranking', metavar='FILE',\
+                        help='Also write all the companies, best first, to FILE, whatever their number (implies '
+                             '--stream).')
+
+    args = parser.parse_args()
+    if (args.stream or args.ranking) and args.top <= 0:
+        parser.error('--stream and --ranking need --top')
+    main(args)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import sys
+import queue
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from BaseDeclarations import RegafiDBSession, IngestedPage, BULK_BATCH_SIZE
+from Company import Company
+from CrawlState import PipelineJournalEntry
+import DownloadAll
+import RegaLog
+
+
+QUEUE_SIZE = 64
+END = None
+
+
+def fetchStage(cib, parseQueue, keepRaw):
+    """ Runs in the download pool: hands the description of the firm over to the parser, with its manifest entry (see
+        IngestedPage). Pages which are not kept have neither mtime nor content hash: regasniff parses them again if
+        they ever reach the store, and does not take them for removed meanwhile. """
+    print("Processing CIB %s..." % cib)
+    DownloadAll.crawlJournal.markPending(cib)
+    try:
+        searchResultsDiv = DownloadAll.downloadCIB(cib)
+    except Exception as e:
+        print("Error while processing CIB %s (%s), skipping" % (cib, e), file=sys.stderr)
+        searchResultsDiv = None
+    if searchResultsDiv is None:
+        DownloadAll.crawlJournal.markFailed(cib)
+        return
+
+    entry = {'cib': cib, 'mtime': None, 'content_hash': '', 'status': IngestedPage.STORED}
+    if keepRaw:
+        pageStore = DownloadAll.pageStore
+        page = searchResultsDiv.prettify() if pageStore.PRETTIFY else str(searchResultsDiv)
+        pageStore.put(cib, page)
+        entry['mtime'] = pageStore.mtime(cib)
+        entry['content_hash'] = hashlib.sha1(page.encode('utf-8')).hexdigest()
+    parseQueue.put((entry, searchResultsDiv))
+
+
+def drain(inputQueue):
+    """ Consumes what is left of the input of a stage which died, so that the stages feeding it never block on a full
+        queue: the firms it drops are left pending in the journal, and retried on next run """
+    while inputQueue.get() is not END:
+        pass
+
+
+def parseStage(parseQueue, writeQueue):
+    item = None
+    try:
+        while True:
+            item = parseQueue.get()
+            if item is END:
+                return
+
+            entry, searchResultsDiv = item
+            cib = entry['cib']
+            try:
+                # Do not process agents
+                if DownloadAll.workList.isAgent(cib):
+                    DownloadAll.crawlJournal.markDone(cib)
+                    continue
+                with DownloadAll.runStats.time('extract'):
+                    company = Company.makeFromMainDiv(searchResultsDiv, cib)
+                    record = company.toRecord() if company is not None else None
+            except Exception as e:
+                RegaLog.logger.error("[CIB: {}] {}".format(cib, e))
+                DownloadAll.crawlJournal.markFailed(cib)
+                continue
+            if record is None:
+                entry['status'] = IngestedPage.SKIPPED
+            writeQueue.put((entry, record))
+    finally:
+        # even if this stage dies, for the writer to stop
+        writeQueue.put(END)
+        if item is not END:
+            drain(parseQueue)
+
+
+def writeStage(writeQueue, DBSession, batchSize=BULK_BATCH_SIZE):
+    """ The only stage touching the database, so that SQLite sees a single writer. Companies are upserted in batches
+        (see RegafiDBSession.bulkLoad) of whatever is queued, up to batchSize, so that a slow crawl still stores them
+        as they come. """
+    item = None
+    try:
+        while True:
+            batch = []
+            item = writeQueue.get()
+            while item is not END:
+                batch.append(item)
+                if len(batch) >= batchSize or writeQueue.empty():
+                    break
+                item = writeQueue.get()
+            if batch:
+                storeBatch(batch, DBSession)
+            if item is END:
+                return
+    finally:
+        if item is not END:
+            drain(writeQueue)
+
+
+def storeBatch(batch, DBSession):
+    """ :param batch: (manifest entry, record) of each page, cf. RegafiDBSession.bulkLoad """
+    cibs = [entry['cib'] for entry, record in batch]
+    try:
+        # companies already stored, e.g. by a previous complete run, are replaced
+        DBSession.bulkLoad(batch, len(batch), replace=True, stats=DownloadAll.runStats)
+    except Exception as e:
+        # e.g. database locked: the batch is rolled back as a whole
+        RegaLog.logger.error("[CIB: {}] Unable to store the companies ({})".format(', '.join(cibs), e))
+        for cib in cibs:
+            DownloadAll.crawlJournal.markFailed(cib)
+        return
+    # a firm is only done once stored, so that an interrupted pipeline resumes from what the database holds
+    for cib in cibs:
+        DownloadAll.crawlJournal.markDone(cib)
+        DownloadAll.runStats.count('pages')
+
+
+def main(args):
+    # a rebuilt database holds none of the firms the journal says are done
+    args.restart = args.restart or args.force_rebuild
+    DownloadAll.prepare(args, journal=PipelineJournalEntry)
+    DBSession = RegafiDBSession(reset=args.force_rebuild)
+    parseQueue = queue.Queue(QUEUE_SIZE)
+    writeQueue = queue.Queue(QUEUE_SIZE)
+
+    print("Starting...")
+    parser = threading.Thread(target=parseStage, args=(parseQueue, writeQueue), name='parser')
+    writer = threading.Thread(target=writeStage, args=(writeQueue, DBSession), name='writer')
+    parser.start()
+    writer.start()
+    try:
+        slots = threading.BoundedSemaphore(2 * args.workers)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for cib in DownloadAll.crawlJournal.remaining(DownloadAll.workList):
+                slots.acquire()
+                executor.submit(fetchStage, cib, parseQueue, args.keep_raw).add_done_callback(
+                    lambda future: slots.release())
+    finally:
+        parseQueue.put(END)
+        parser.join()
+        writer.join()
+        DownloadAll.httpClient.close()
+        DownloadAll.pageStore.close()
+
+    crawlJournal = DownloadAll.crawlJournal
+    failed = crawlJournal.count(crawlJournal.FAILED)
+    print("Done: %d CIBs stored, %d failed (will be retried on next run)" % (crawlJournal.count(crawlJournal.DONE), failed))
+    if not failed:
+        crawlJournal.clear()
+    DownloadAll.writeStats(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+                                     'This software downloads, parses and stores every firm of the Regafi export '
+                                     'in a single pass: the database fills while the crawl runs.')
+    DownloadAll.addCrawlArguments(parser)
+    parser.add_argument('-f', '--force-rebuild', action='store_true',\
+                        help='Force to rebuild all the database from scratch (implies --restart).')
+    parser.add_argument('-k', '--keep-raw', action='store_true',\
+                        help='Also save the pages downloaded, as DownloadAll does.')
+
+    args = parser.parse_args()
+    main(args)
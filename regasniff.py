@@ -20,33 +20,165 @@ along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
 """
 
 
-import os
+import time
+import hashlib
 import argparse
+import multiprocessing
 from bs4 import BeautifulSoup
-from BaseDeclarations import RegafiDBSession
-from Company import Company
-
-
-SAVE_DIR = 'RawResults'
+from BaseDeclarations import RegafiDBSession, IngestedPage, BULK_BATCH_SIZE
+from Company import Company, SoupParser
+from RawStore import openStore
+from RegaStats import RunStats
+from WorkList import isAgent
+import FastExtractor
+import RegaLog
+
+
+CHUNK_SIZE = 16
+
+# store the pages are read from by parseRecord, in every process parsing them
+workerStore = None
+
+
+def initWorker(archive, store=None):
+    """ Pool initializer, each process reading the pages it parses, so that they do not go through the pool
+        :param store: the store to read from, opened read-only if not given
+    """
+    global workerStore
+    workerStore = store if store is not None else openStore(archive=archive, readOnly=True)
+
+
+def makeCompany(cib, chunks, parser, restricted, timings):
+    """ :param chunks: the page as an iterator over utf-8 chunks, parsed as they are read unless parser is 'soup'
+        :param timings: dict filled with the time spent in the 'parse' (reading included) and 'extract' stages
+    """
+    start = time.monotonic()
+    if parser == 'soup':
+        mainDiv = BeautifulSoup(b''.join(chunks).decode('utf-8'), "lxml",
+                                parse_only=SoupParser.STRAINER if restricted else None)
+        htmlParser = SoupParser
+    else:
+        mainDiv = FastExtractor.parseChunks(chunks, restricted)
+        htmlParser = FastExtractor.XPathParser
+    parsed = time.monotonic()
+    timings['parse'] = parsed - start
+    company = Company.makeFromMainDiv(mainDiv, cib, parser=htmlParser)
+    if parser == 'soup':
+        mainDiv.decompose()         # soup trees are full of cycles, the garbage collector would free them much later
+    timings['extract'] = time.monotonic() - parsed
+    return company
+
+
+def hashChunks(chunks, digest):
+    """ :return chunks, digest being updated with each of them as they are read """
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def hashPage(chunks):
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parseRecord(item):
+    """ Reads the page from workerStore, hashing it as it is parsed
+        :return (manifest entry of the page, company as a plain record or None, stage timings), cf. Company.toRecord:
+        records are all that leaves the worker processes """
+    cib, mtime, parser, restricted = item
+    entry = {'cib': cib, 'mtime': mtime, 'status': IngestedPage.STORED}
+    timings = dict()
+    digest = hashlib.sha1()
+    try:
+        chunks = workerStore.chunks(cib)
+        if chunks is None:
+            raise FileNotFoundError("Page removed before being parsed")
+        company = makeCompany(cib, hashChunks(chunks, digest), parser, restricted, timings)
+    except Exception as e:
+        RegaLog.logger.error("[CIB: {}] {}".format(cib, e))
+        entry['status'] = IngestedPage.FAILED
+        entry['content_hash'] = digest.hexdigest()      # of what was read, never compared for pages which failed
+        return entry, None, timings
+    entry['content_hash'] = digest.hexdigest()
+    if company is None:
+        entry['status'] = IngestedPage.SKIPPED
+        return entry, None, timings
+    return entry, company.toRecord(), timings
+
+
+def recordStats(results, stats):
+    """ Accounts for the pages parsed, possibly in other processes, on their way to the database """
+    for entry, record, timings in results:
+        for stage, seconds in timings.items():
+            stats.record(stage, seconds)
+        stats.count(entry['status'])
+        stats.count('pages')
+        yield entry, record
+
+
+def changedPages(store, manifest, touched, stats):
+    """ :return (cib, mtime) for every page to parse: new ones, those whose content changed and those which failed
+        last time. Pages only read because their mtime changed are added to touched (CIB -> mtime).
+    """
+    for cib in store.cibs():
+        # Do not process agents
+        if isAgent(cib):
+            continue
+        entry = manifest.get(cib)
+        upToDate = entry is not None and entry.status != IngestedPage.FAILED
+        mtime = store.mtime(cib)
+        if mtime is None:
+            continue
+        if upToDate and entry.mtime == mtime:
+            stats.count('unchanged')
+            continue
+        if upToDate:
+            with stats.time('read'):
+                chunks = store.chunks(cib)
+                if chunks is None:
+                    continue
+                contentHash = hashPage(chunks)
+            if entry.content_hash == contentHash:
+                stats.count('unchanged')
+                touched[cib] = mtime
+                continue
+        yield cib, mtime
 
 
 def main(args):
+    stats = RunStats(args.progress)
     DBSession = RegafiDBSession(reset=args.force_rebuild)
-
-    session = DBSession()
-    for filename in os.listdir(SAVE_DIR):
-        cib = filename.split('.')[0]
-        # Do not process agents
-        if int(cib) > 100000:
-            continue
-
-        with open(SAVE_DIR + '/' + filename, 'r') as f:
-            mainDiv = BeautifulSoup(f.read(), "lxml")
-
-        company = Company.makeFromMainDiv(mainDiv, cib)
-        if company is not None:
-            company.save(session)
-    session.close()
+    store = openStore(archive=args.archive, readOnly=True)
+    manifest = DBSession.loadManifest()
+    touched = dict()
+
+    # pages are read by the processes parsing them, only their CIB goes through the pool
+    items = ((cib, mtime, args.parser, not args.full_parse)
+             for cib, mtime in changedPages(store, manifest, touched, stats))
+    # after a rebuild the database is empty, otherwise companies parsed again replace the ones stored
+    replace = not args.force_rebuild
+    if args.workers > 1:
+        # the pool reads and parses, this process is the only one writing
+        with multiprocessing.Pool(args.workers, initWorker, (args.archive,)) as pool:
+            results = pool.imap_unordered(parseRecord, items, CHUNK_SIZE)
+            count = DBSession.bulkLoad(recordStats(results, stats), args.batch_size, args.synchronous, replace, stats)
+    else:
+        initWorker(args.archive, store)
+        results = map(parseRecord, items)
+        count = DBSession.bulkLoad(recordStats(results, stats), args.batch_size, args.synchronous, replace, stats)
+    DBSession.touchManifest(touched)
+
+    # pages without mtime were stored by regapipe without being kept, they never were in the store
+    removed = {cib for cib, entry in manifest.items() if entry.mtime is not None}.difference(
+        cib for cib in store.cibs() if not isAgent(cib))
+    DBSession.bulkDelete(removed)
+    store.close()
+    stats.count('removed', len(removed))
+    print("%d companies stored, %d removed" % (count, len(removed)))
+    if args.stats:
+        stats.write(args.stats)
 
 
 if __name__ == '__main__':
@@ -54,9 +186,28 @@ if __name__ == '__main__':
                                      'This software rebuilds the Regafi database and '
                                      'so that you can exploit it more conveniently, '
                                      'performing searches on several criteria instead of '
-                                     'just being able to look for specific institutions.')
+                                     'just being able to look for specific institutions. Only the pages which '
+                                     'changed since the last run are parsed again.')
     parser.add_argument('-f', '--force-rebuild', action='store_true',\
                         help='Force to rebuild all the database from scratch.')
+    parser.add_argument('-a', '--archive', action='store_true',\
+                        help='Read pages from the compressed RawResults.archive instead of RawResults.')
+    parser.add_argument('-p', '--parser', choices=['xpath', 'soup'], default='xpath',\
+                        help='Extract firms with compiled XPath expressions (default) or with BeautifulSoup.')
+    parser.add_argument('--full-parse', action='store_true',\
+                        help='Parse whole pages, instead of the description and French activities divs only.')
+    parser.add_argument('-w', '--workers', type=int, default=1,\
+                        help='Number of processes parsing pages, the database being written by this one only.')
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE,\
+                        help='Number of companies written per transaction (default: %d).' % BULK_BATCH_SIZE)
+    parser.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'], default='NORMAL',\
+                        help='SQLite synchronous level while loading (default: NORMAL). OFF is the fastest, but a '
+                             'crash of the host during the load may corrupt the database.')
+    parser.add_argument('--stats', metavar='FILE',\
+                        help='Write the time spent in each stage (read, parse, extract, save) and the throughput of '
+                             'the run to this JSON file.')
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS',\
+                        help='Print a progress line every SECONDS seconds.')
 
     args = parser.parse_args()
     main(args)
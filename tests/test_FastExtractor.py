@@ -0,0 +1,119 @@
+"""
+Copyright © 2017 Nicolas Garnier (nicolas@github.equinoxe.ovh).
+This file is part of RegaFinder, a personal tool designed to perform
+reverse searches in the French financial firms register REGAFI.
+
+RegaFinder is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+RegaFinder is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RegaFinder. If not, see <http://www.gnu.org/licenses/>
+"""
+
+
+import os
+import re
+import sys
+import unittest
+from bs4 import BeautifulSoup
+from sqlalchemy import inspect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from BaseDeclarations import CompanyDescription
+from Company import Company, SoupParser
+import FastExtractor
+import RegaLog
+
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+# What the original BeautifulSoup parser (before the XPath extractor) made of the pages in PAGES_DIR, stored prettified
+# as DownloadAll does: (class, non-empty columns, (service, instrument) provided, activities authorized)
+EXPECTED = {
+    # domestic investment firm, ACPR grid and activities
+    '10044': ('InvestmentServicesCompany',
+              {'cib': 10044, 'name': 'SYNTHETIC FIRM 10044', 'type': "Entreprise d'investissement",
+               'siren': '213849537', 'auth_type': 'Agrément ACPR', 'city': 'Paris'},
+              {(1, 2), (1, 3), (2, 2), (3, 1), (3, 4), (4, 2), (5, 5), (6, 3), (7, 5), (8, 1), (8, 3), (9, 3)},
+              [2]),
+    # passported investment firm, CB grid
+    '10033': ('EUInvestmentServicesCompany',
+              {'cib': 10033, 'name': 'SYNTHETIC FIRM 10033', 'type': "Entreprise d'investissement (EU)",
+               'siren': '586753764', 'auth_type': 'Passeport européen en entrée', 'city': 'Paris'},
+              {(1, 1), (1, 4), (1, 5), (1, 7), (1, 10), (2, 7), (2, 8), (3, 3), (3, 4), (3, 9), (4, 4), (4, 5),
+               (4, 9), (5, 1), (5, 3), (5, 9), (5, 10), (6, 4), (6, 5), (6, 6), (6, 9), (6, 10), (7, 2), (7, 3),
+               (7, 7), (7, 9), (7, 10), (8, 1), (8, 2), (8, 3), (8, 7), (8, 9), (9, 2), (9, 3), (9, 4), (9, 5),
+               (9, 7), (9, 8), (9, 10), (10, 1), (10, 4), (10, 5), (10, 6), (10, 8), (10, 9), (10, 10), (11, 2),
+               (11, 7), (11, 8), (11, 10), (12, 1), (12, 2), (12, 8), (12, 9), (13, 1), (13, 5), (13, 7), (13, 8),
+               (14, 1), (14, 6), (14, 8), (15, 3), (15, 5), (15, 6), (15, 8), (15, 9)},
+              []),
+}
+
+
+def readPage(cib):
+    with open(os.path.join(PAGES_DIR, cib + '.div'), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def summarize(company):
+    """ :return the company as EXPECTED describes it """
+    properties = {column.key: getattr(company, column.key) for column in inspect(CompanyDescription).column_attrs
+                  if getattr(company, column.key) is not None and not column.key.endswith('mask')}
+    return type(company).__name__, properties, \
+        {(service.service, service.instrument) for service in company.provided_services}, \
+        sorted(activity.activity for activity in company.authorized_activities)
+
+
+def streamed(page, cib):
+    page = page.encode('utf-8')
+    # small chunks, for the regions to straddle them
+    chunks = (page[n:n + FastExtractor.CHECK_CHUNK_SIZE] for n in range(0, len(page), FastExtractor.CHECK_CHUNK_SIZE))
+    return Company.makeFromMainDiv(FastExtractor.parseChunks(chunks), cib, parser=FastExtractor.XPathParser)
+
+
+class ExtractorTest(unittest.TestCase):
+    PARSERS = {
+        'XPath': lambda page, cib: FastExtractor.makeCompany(page, cib, restricted=False),
+        'XPath restricted': FastExtractor.makeCompany,
+        'XPath streamed': streamed,
+        'BeautifulSoup': lambda page, cib: Company.makeFromMainDiv(BeautifulSoup(page, "lxml"), cib),
+        'BeautifulSoup restricted': lambda page, cib: Company.makeFromMainDiv(
+            BeautifulSoup(page, "lxml", parse_only=SoupParser.STRAINER), cib),
+    }
+
+    def test_pages(self):
+        for cib, expected in EXPECTED.items():
+            page = readPage(cib)
+            for name, parse in self.PARSERS.items():
+                with self.subTest(cib=cib, parser=name):
+                    self.assertEqual(summarize(parse(page, cib)), expected)
+
+    def test_shuffledGrid(self):
+        # the rows and cells of the grid of 10044 in random order: their headers still place them
+        page = readPage('shuffled-10044')
+        for name, parse in self.PARSERS.items():
+            with self.subTest(parser=name):
+                self.assertEqual(summarize(parse(page, '10044')), EXPECTED['10044'])
+
+    def test_unplacedGrid(self):
+        # headers naming no heading: the cells are taken in page order, which is the grid's own in 10044
+        page = re.sub(r'headers="[^"]*"', 'headers="unknown"', readPage('10044'))
+        RegaLog.logger.disabled = False
+        try:
+            for name, parse in self.PARSERS.items():
+                with self.subTest(parser=name), self.assertLogs(RegaLog.logger, 'WARNING') as logs:
+                    self.assertEqual(summarize(parse(page, '10044')), EXPECTED['10044'])
+                    self.assertIn('[CIB: 10044]', logs.output[0])
+        finally:
+            RegaLog.logger.disabled = True
+
+
+if __name__ == '__main__':
+    unittest.main()